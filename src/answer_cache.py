@@ -0,0 +1,175 @@
+import hashlib
+import math
+import re
+import time
+from collections import Counter, OrderedDict
+
+from config import ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY
+from metrics import cache_requests, cache_entries
+
+NGRAM_SIZE = 3
+# Сколько кандидатов с наибольшим числом общих n-грамм сравнивать по косинусной мере
+MAX_CANDIDATES = 20
+# Слова короче этого (предлоги, «не», числа) должны совпадать точно; у длинных допускается разное окончание
+STEM_MIN_LENGTH = 5
+STEM_SUFFIX = 2
+# Подстановка вместо имени пользователя: в ответах DeepSeek часто обращается по имени
+NAME_PLACEHOLDER = "\x00name\x00"
+# Короткие имена («Да», «Ия») совпадают с обычными словами: такие ответы не кэшируются
+NAME_MIN_LENGTH = 3
+# Приветствие — начало ответа до конца первого предложения: имя заменяется только там
+GREETING_RE = re.compile(r'[^.!?\n]*')
+
+
+def normalize_question(text: str) -> str:
+    """Нормализовать вопрос: регистр, ё, пунктуация и лишние пробелы не влияют на ключ кэша"""
+    text = text.lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return ' '.join(text.split())
+
+
+def _ngrams(text: str) -> Counter:
+    padded = f" {text} "
+    return Counter(padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1))
+
+
+def _stems(text: str) -> frozenset:
+    """Слова вопроса без окончаний: «беременным» и «беременной» совпадают, «пиво» и «кофе», «3» и «5» — нет"""
+    return frozenset(
+        word[:-STEM_SUFFIX] if len(word) >= STEM_MIN_LENGTH and not word.isdigit() else word
+        for word in text.split()
+    )
+
+
+def _template(answer: str, user_name: str):
+    """Ответ с подстановкой вместо имени в приветствии; None, если ответ нельзя отдать другим пользователям"""
+    if not user_name:
+        return answer
+    if len(user_name) < NAME_MIN_LENGTH:
+        return None
+    # Только целое слово: «Дайте» не содержит имя «Да»
+    name = re.compile(rf'(?<!\w){re.escape(user_name)}(?!\w)', re.IGNORECASE)
+    end = GREETING_RE.match(answer).end()
+    rest = answer[end:]
+    if name.search(rest):
+        # Имя в середине ответа: подстановка там может задеть обычное слово, а без нее другой увидит чужое имя
+        return None
+    return name.sub(NAME_PLACEHOLDER, answer[:end], count=1) + rest
+
+
+class _Entry:
+    __slots__ = ('period', 'answer', 'expires_at', 'ngrams', 'stems')
+
+    def __init__(self, period, answer, expires_at, ngrams, stems):
+        self.period = period
+        self.answer = answer
+        self.expires_at = expires_at
+        self.ngrams = ngrams
+        self.stems = stems
+
+
+class AnswerCache:
+    """Кэш ответов LLM: точное совпадение по хэшу нормализованного вопроса и периода,
+    затем (если включено) поиск похожего вопроса по TF-IDF символьных n-грамм. TTL и вытеснение LRU.
+    Похожий вопрос засчитывается, только если совпадают все слова (с точностью до окончания):
+    другое число, отрицание или другое существительное — это другой вопрос"""
+
+    def __init__(self, max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, similarity=ANSWER_CACHE_SIMILARITY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        # Инвертированный индекс n-грамма -> ключи и частота n-грамм по документам для IDF
+        self._index = {}
+        self._df = Counter()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        # hits включает similar_hits: в метриках точные и похожие совпадения разделены
+        cache_requests.track(lambda: self.hits - self.similar_hits, cache='answer', result='hit')
+        cache_requests.track(lambda: self.similar_hits, cache='answer', result='similar')
+        cache_requests.track(lambda: self.misses, cache='answer', result='miss')
+        cache_entries.track(lambda: len(self._entries), cache='answer')
+
+    @staticmethod
+    def _key(normalized, period):
+        return hashlib.sha1(f"{period}\n{normalized}".encode('utf-8')).hexdigest()
+
+    def get(self, question: str, period: str, user_name: str = ''):
+        normalized = normalize_question(question)
+        key = self._key(normalized, period)
+        entry = self._entries.get(key)
+        if entry and entry.expires_at < time.monotonic():
+            self._remove(key)
+            entry = None
+        if entry is None and self.similarity:
+            key = self._find_similar(normalized, period)
+            entry = self._entries.get(key) if key else None
+            if entry:
+                self.similar_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry.answer.replace(NAME_PLACEHOLDER, user_name)
+
+    def put(self, question: str, period: str, answer: str, user_name: str = ''):
+        answer = _template(answer, user_name)
+        if answer is None:
+            return
+        normalized = normalize_question(question)
+        key = self._key(normalized, period)
+        if key in self._entries:
+            self._remove(key)
+        ngrams = _ngrams(normalized) if self.similarity else None
+        stems = _stems(normalized) if self.similarity else None
+        self._entries[key] = _Entry(period, answer, time.monotonic() + self.ttl, ngrams, stems)
+        if ngrams:
+            for gram in ngrams:
+                self._index.setdefault(gram, set()).add(key)
+                self._df[gram] += 1
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        if entry.ngrams:
+            for gram in entry.ngrams:
+                keys = self._index.get(gram)
+                if keys:
+                    keys.discard(key)
+                    if not keys:
+                        del self._index[gram]
+                self._df[gram] -= 1
+                if self._df[gram] <= 0:
+                    del self._df[gram]
+
+    def _weights(self, ngrams):
+        total = len(self._entries) + 1
+        return {gram: count * (math.log(total / (self._df.get(gram, 0) + 1)) + 1) for gram, count in ngrams.items()}
+
+    def _find_similar(self, normalized, period):
+        query = _ngrams(normalized)
+        stems = _stems(normalized)
+        now = time.monotonic()
+        # Период и срок проверяются до отбора кандидатов: записи других периодов не вытесняют подходящие
+        overlap = Counter()
+        for gram in query:
+            for key in self._index.get(gram, ()):
+                entry = self._entries[key]
+                if entry.period == period and entry.expires_at >= now and entry.stems == stems:
+                    overlap[key] += 1
+
+        query_weights = self._weights(query)
+        query_norm = math.sqrt(sum(w * w for w in query_weights.values()))
+        best_key, best_score = None, self.similarity
+        for key, _ in overlap.most_common(MAX_CANDIDATES):
+            entry = self._entries[key]
+            weights = self._weights(entry.ngrams)
+            norm = math.sqrt(sum(w * w for w in weights.values()))
+            dot = sum(w * weights.get(gram, 0.0) for gram, w in query_weights.items())
+            score = dot / (query_norm * norm) if query_norm and norm else 0.0
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
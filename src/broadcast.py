@@ -0,0 +1,421 @@
+import asyncio
+import logging
+import time
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import Message, MessageEntity
+
+from config import (
+    BROADCAST_CONCURRENCY, BROADCAST_RATE, BROADCAST_PER_CHAT_INTERVAL,
+    BROADCAST_PROGRESS_INTERVAL, BROADCAST_MAX_RETRIES, DELIVERY_FLUSH_SIZE, DELIVERY_FLUSH_INTERVAL,
+    REPLICA_ID, BROADCAST_SHARD_LEASE_TTL, BROADCAST_POLL_INTERVAL
+)
+from database import (
+    create_broadcast_job, get_broadcast_job, claim_broadcast_shard, renew_broadcast_shard, release_broadcast_shard,
+    count_open_broadcast_shards, get_pending_deliveries, get_delivery_counts, save_delivery_results,
+    save_user_delivery_state, finish_broadcast_job
+)
+from middlewares import forget_active_users
+from metrics import broadcast_messages, broadcast_errors, broadcast_retry_after
+from utils import spawn
+from logs import log_context
+
+logger = logging.getLogger(__name__)
+
+# Ошибки BadRequest, которые зависят от получателя, а не от сообщения или Telegram
+RECIPIENT_ERRORS = ("user not found", "peer_id_invalid", "not enough rights", "have no rights", "bot can't initiate")
+
+# Типы вложений, которые отправляются через bot.send_<type>(file_id, caption, caption_entities).
+# animation проверяется раньше document: у GIF Telegram заполняет оба поля
+MEDIA_TYPES = ('photo', 'video', 'audio', 'voice', 'animation', 'document')
+
+class RateLimiter:
+    """Token bucket для глобального лимита Telegram плюс минимальный интервал для одного чата"""
+
+    def __init__(self, rate, per_chat_interval=1.0, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.per_chat_interval = per_chat_interval
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._chat_next = {}
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Остановить все отправки на время RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def _wait_chat(self, chat_id):
+        now = time.monotonic()
+        next_allowed = self._chat_next.get(chat_id, 0.0)
+        if next_allowed > now:
+            await asyncio.sleep(next_allowed - now)
+        self._chat_next[chat_id] = time.monotonic() + self.per_chat_interval
+        # Не даем словарю расти бесконечно во время больших рассылок
+        if len(self._chat_next) > 10000:
+            now = time.monotonic()
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+
+    async def acquire(self, chat_id):
+        await self._wait_chat(chat_id)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Общий лимитер: ручная рассылка и ежедневные сообщения делят один лимит бота
+limiter = RateLimiter(BROADCAST_RATE, BROADCAST_PER_CHAT_INTERVAL)
+
+
+def payload_from_message(message: Message):
+    """Описание сообщения для рассылки (только file_id и текст, без самого объекта Message)"""
+    for kind in MEDIA_TYPES:
+        media = getattr(message, kind)
+        if media:
+            file_id = media[-1].file_id if kind == 'photo' else media.file_id
+            return {
+                'type': kind,
+                'file_id': file_id,
+                'caption': message.caption,
+                'entities': _dump_entities(message.caption_entities),
+            }
+    if message.video_note:
+        return {'type': 'video_note', 'file_id': message.video_note.file_id}
+    if message.sticker:
+        return {'type': 'sticker', 'file_id': message.sticker.file_id}
+    if message.text:
+        return {'type': 'text', 'text': message.text, 'entities': _dump_entities(message.entities)}
+    # Для других типов используем copy_message
+    return {'type': 'copy', 'from_chat_id': message.chat.id, 'message_id': message.message_id}
+
+
+def _dump_entities(entities):
+    return [entity.dict(exclude_none=True) for entity in entities] if entities else None
+
+
+def _load_entities(entities):
+    return [MessageEntity(**entity) for entity in entities] if entities else None
+
+
+async def send_payload(bot: Bot, chat_id, payload):
+    """Отправить одно сообщение рассылки пользователю"""
+    kind = payload['type']
+    if kind == 'text':
+        await bot.send_message(chat_id=chat_id, text=payload['text'], entities=_load_entities(payload.get('entities')))
+    elif kind in MEDIA_TYPES:
+        method = getattr(bot, f'send_{kind}')
+        await method(
+            chat_id=chat_id,
+            caption=payload.get('caption'),
+            caption_entities=_load_entities(payload.get('entities')),
+            **{kind: payload['file_id']}
+        )
+    elif kind == 'video_note':
+        await bot.send_video_note(chat_id=chat_id, video_note=payload['file_id'])
+    elif kind == 'sticker':
+        await bot.send_sticker(chat_id=chat_id, sticker=payload['file_id'])
+    else:
+        await bot.copy_message(chat_id=chat_id, from_chat_id=payload['from_chat_id'], message_id=payload['message_id'])
+
+
+def classify_error(error):
+    """Разделить ошибки отправки: 'blocked' — пользователь заблокировал бота или удален,
+    'unreachable' — ошибка на стороне получателя (считается в DELIVERY_FAILURE_LIMIT),
+    'failed' — сеть, сервер Telegram или само сообщение: получатель не виноват"""
+    if isinstance(error, TelegramForbiddenError):
+        return 'blocked'
+    error_msg = str(error).lower()
+    if isinstance(error, TelegramBadRequest) and "chat not found" in error_msg:
+        return 'blocked'
+    if "blocked" in error_msg or "forbidden" in error_msg or "deactivated" in error_msg:
+        return 'blocked'
+    if isinstance(error, TelegramBadRequest) and any(text in error_msg for text in RECIPIENT_ERRORS):
+        return 'unreachable'
+    return 'failed'
+
+
+class Broadcast:
+    """Отправка части рассылки с ограниченным числом одновременных отправок.
+    Результат по каждому получателю передается в on_result; прогресс задания считает JobProgress по БД"""
+
+    def __init__(self, bot: Bot, user_ids, payload, on_result=None,
+                 concurrency=BROADCAST_CONCURRENCY, rate_limiter=None, payloads=None):
+        self.bot = bot
+        self.user_ids = user_ids
+        self.payload = payload
+        # Свои payload для отдельных получателей (user_id -> payload), остальным уходит общий
+        self.payloads = payloads or {}
+        self.on_result = on_result
+        self.concurrency = concurrency
+        self.limiter = rate_limiter or limiter
+        self.success_count = 0
+        self.failed_count = 0
+        self.blocked_count = 0
+
+    async def run(self):
+        recipients = iter(self.user_ids)
+        workers = [
+            asyncio.create_task(self._worker(recipients))
+            for _ in range(min(self.concurrency, len(self.user_ids)))
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        return self
+
+    async def _worker(self, recipients):
+        # Общий итератор: каждый воркер берет следующего пользователя, пока они не кончатся
+        for user_id in recipients:
+            status = await self._deliver(user_id)
+            broadcast_messages.inc(status=status)
+            if status == 'sent':
+                self.success_count += 1
+            elif status == 'blocked':
+                self.blocked_count += 1
+            else:
+                self.failed_count += 1
+            if self.on_result:
+                await self.on_result(user_id, status)
+
+    async def _deliver(self, user_id):
+        for _ in range(BROADCAST_MAX_RETRIES + 1):
+            await self.limiter.acquire(user_id)
+            try:
+                await send_payload(self.bot, user_id, self.payloads.get(user_id, self.payload))
+                return 'sent'
+            except TelegramRetryAfter as e:
+                broadcast_retry_after.inc()
+                self.limiter.pause(e.retry_after)
+            except Exception as e:
+                status = classify_error(e)
+                logger.debug("Ошибка при отправке пользователю %s: %s", user_id, e, extra={'status': status})
+                broadcast_errors.inc(status=status, error=type(e).__name__)
+                return status
+        return 'failed'
+
+
+class DeliveryRecorder:
+    """Копит результаты доставки и сохраняет их в БД пачками"""
+
+    def __init__(self, pool, job_id, batch_size=DELIVERY_FLUSH_SIZE, interval=DELIVERY_FLUSH_INTERVAL):
+        self.pool = pool
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self.interval = interval
+        self._results = []
+        self._flushed_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def __call__(self, user_id, status):
+        self._results.append((user_id, status))
+        if len(self._results) >= self.batch_size or time.monotonic() - self._flushed_at >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            results, self._results = self._results, []
+            self._flushed_at = time.monotonic()
+            if results:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        # В задании 'unreachable' считается обычной ошибкой; различие нужно только счетчику пользователя
+                        await save_delivery_results(
+                            conn, self.job_id,
+                            [(user_id, 'failed' if status == 'unreachable' else status) for user_id, status in results]
+                        )
+                        await save_user_delivery_state(conn, results)
+                forget_active_users([user_id for user_id, status in results if status == 'blocked'])
+
+
+async def create_job(pool, kind, payload, user_ids, status_message: Message = None):
+    """Сохранить задание рассылки в БД до начала отправки"""
+    async with pool.acquire() as conn:
+        return await create_broadcast_job(
+            conn, kind, payload, user_ids,
+            status_chat_id=status_message.chat.id if status_message else None,
+            status_message_id=status_message.message_id if status_message else None
+        )
+
+
+class JobProgress:
+    """Прогресс задания по счетчикам из БД: учитывает отправки всех реплик"""
+
+    def __init__(self, counts, started_at=None, started_done=0):
+        self.success_count = counts.get('sent', 0)
+        self.failed_count = counts.get('failed', 0)
+        self.blocked_count = counts.get('blocked', 0)
+        self.total = sum(counts.values())
+        self.started_at = started_at
+        self._started_done = started_done
+
+    @property
+    def done_count(self):
+        return self.success_count + self.failed_count + self.blocked_count
+
+    @property
+    def rate(self):
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0
+        return (self.done_count - self._started_done) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        rate = self.rate
+        return (self.total - self.done_count) / rate if rate > 0 else None
+
+
+async def process_shard(bot: Bot, pool, job_id, shard, first_user_id, last_user_id):
+    """Отправить часть рассылки, пока реплика держит её аренду"""
+    async with pool.acquire() as conn:
+        job = await get_broadcast_job(conn, job_id)
+        pending = await get_pending_deliveries(conn, job_id, first_user_id, last_user_id)
+
+    user_ids = [user_id for user_id, _ in pending]
+    payloads = {user_id: payload for user_id, payload in pending if payload is not None}
+    logger.info("Отправка части рассылки: %s получателей", len(user_ids))
+    recorder = DeliveryRecorder(pool, job_id)
+    sending = asyncio.create_task(
+        Broadcast(bot, user_ids, job['payload'], on_result=recorder, payloads=payloads).run()
+    )
+    done = False
+    try:
+        # Продлеваем аренду, пока идет отправка; если часть забрала другая реплика — останавливаемся
+        while not sending.done():
+            await asyncio.wait([sending], timeout=BROADCAST_SHARD_LEASE_TTL / 3)
+            if sending.done():
+                break
+            async with pool.acquire() as conn:
+                if not await renew_broadcast_shard(conn, job_id, shard, REPLICA_ID, BROADCAST_SHARD_LEASE_TTL):
+                    logger.warning("Аренда части рассылки потеряна, отправка остановлена")
+                    sending.cancel()
+        await sending
+        done = True
+    except asyncio.CancelledError:
+        if sending.cancelled():
+            return
+        raise
+    finally:
+        sending.cancel()
+        await recorder.flush()
+        # При остановке реплики часть сразу возвращается остальным
+        async with pool.acquire() as conn:
+            await release_broadcast_shard(conn, job_id, shard, REPLICA_ID, done)
+
+    await finish_job(bot, pool, job)
+
+
+async def finish_job(bot: Bot, pool, job):
+    """Завершить задание, если все части отправлены. Итог в статусное сообщение пишет только завершившая реплика"""
+    async with pool.acquire() as conn:
+        counts = await finish_broadcast_job(conn, job['id'])
+    if counts is not None and job['status_message_id']:
+        try:
+            await bot.edit_message_text(
+                format_result(JobProgress(counts)),
+                chat_id=job['status_chat_id'], message_id=job['status_message_id']
+            )
+        except Exception:
+            pass
+    return counts
+
+
+async def work_shards(bot: Bot, pool, job_id=None):
+    """Отправлять свободные части рассылок (только задания job_id, если он указан), пока они есть"""
+    while True:
+        async with pool.acquire() as conn:
+            claimed = await claim_broadcast_shard(conn, REPLICA_ID, BROADCAST_SHARD_LEASE_TTL, job_id)
+        if claimed is None:
+            return
+        # Записи лога при отправке части помечаются заданием и номером части
+        with log_context(job_id=claimed[0], shard=claimed[1]):
+            await process_shard(bot, pool, *claimed)
+
+
+async def run_job(bot: Bot, pool, job_id):
+    """Выполнить сохраненное задание рассылки вместе с другими репликами и дождаться его завершения.
+    Возвращает итоговый прогресс; прогресс в статусном сообщении обновляет реплика, создавшая задание"""
+    async with pool.acquire() as conn:
+        job = await get_broadcast_job(conn, job_id)
+    reporter = spawn(_report_progress(bot, pool, job)) if job['status_message_id'] else None
+    try:
+        while True:
+            await work_shards(bot, pool, job_id)
+            async with pool.acquire() as conn:
+                if not await count_open_broadcast_shards(conn, job_id):
+                    break
+            # Остальные части отправляют другие реплики; если какая-то упадет, её часть освободится
+            await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+    finally:
+        if reporter:
+            reporter.cancel()
+    await finish_job(bot, pool, job)
+
+    async with pool.acquire() as conn:
+        job = await get_broadcast_job(conn, job_id)
+    return JobProgress({'sent': job['sent_count'], 'blocked': job['blocked_count'], 'failed': job['failed_count']})
+
+
+async def _report_progress(bot: Bot, pool, job):
+    started_at = time.monotonic()
+    started_done = None
+    while True:
+        await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+        try:
+            async with pool.acquire() as conn:
+                counts = await get_delivery_counts(conn, job['id'])
+            if not counts:
+                # Задание завершено: построчные доставки удалены вместе с установкой итогов
+                return
+            if started_done is None:
+                started_done = sum(count for status, count in counts.items() if status != 'pending')
+            await bot.edit_message_text(
+                format_progress(JobProgress(counts, started_at, started_done)), chat_id=job['status_chat_id'], message_id=job['status_message_id']
+            )
+        except Exception:
+            # Ошибка обновления статуса не должна останавливать рассылку
+            pass
+
+
+async def broadcast_worker(bot: Bot, pool):
+    """Фоновая задача каждой реплики: помогать с рассылками и подбирать части, брошенные упавшими репликами"""
+    while True:
+        try:
+            await work_shards(bot, pool)
+        except Exception:
+            logger.exception("Ошибка обработки рассылки")
+        await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+
+
+def format_progress(broadcast):
+    eta = broadcast.eta
+    eta_text = f"{int(eta // 60)} мин {int(eta % 60)} с" if eta is not None else "—"
+    return (
+        f"📤 Рассылка: {broadcast.done_count}/{broadcast.total}\n\n"
+        f"✅ Успешно: {broadcast.success_count}\n"
+        f"🚫 Заблокировали бота: {broadcast.blocked_count}\n"
+        f"❌ Ошибок: {broadcast.failed_count}\n"
+        f"⚡ Скорость: {broadcast.rate:.1f} сообщ./с\n"
+        f"⏳ Осталось: {eta_text}"
+    )
+
+
+def format_result(broadcast):
+    return (
+        f"✅ Рассылка завершена!\n\n"
+        f"✅ Успешно: {broadcast.success_count}\n"
+        f"🚫 Заблокировали бота: {broadcast.blocked_count}\n"
+        f"❌ Ошибок: {broadcast.failed_count}\n"
+        f"📊 Всего: {broadcast.total}"
+    )
@@ -1,4 +1,6 @@
 import os
+import secrets
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,4 +14,164 @@ ADMINS = [int(admin_id) for admin_id in os.getenv("ADMINS").split(",")] if os.ge
 TRIGGER_WORDS = [
     'температур', 'боль', 'кровотеч', 'давлен', 'понос',
     'рвот', 'диаре', 'головокруж', 'сознан'
-]
\ No newline at end of file
+]
+
+# Рассылки: Telegram допускает ~30 сообщений в секунду на бота и ~1 сообщение в секунду в один чат
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+# Скорость задается на реплику: при нескольких репликах общий лимит бота делится между ними
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+# Результаты доставки сохраняются пачками: при падении может повториться не больше одной пачки
+DELIVERY_FLUSH_SIZE = int(os.getenv("DELIVERY_FLUSH_SIZE", "100"))
+DELIVERY_FLUSH_INTERVAL = float(os.getenv("DELIVERY_FLUSH_INTERVAL", "2"))
+# После стольких неудачных по вине получателя доставок подряд пользователь исключается из рассылок
+# до следующего сообщения от него (сбои сети, Telegram и ошибки в самом сообщении не считаются)
+DELIVERY_FAILURE_LIMIT = int(os.getenv("DELIVERY_FAILURE_LIMIT", "5"))
+
+# DeepSeek API: общий пул соединений с keep-alive вместо новой сессии на каждый вопрос
+DEEPSEEK_URL = os.getenv("DEEPSEEK_URL", "https://api.deepseek.com/v1/chat/completions")
+DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "50"))
+LLM_KEEPALIVE_TIMEOUT = float(os.getenv("LLM_KEEPALIVE_TIMEOUT", "60"))
+LLM_DNS_CACHE_TTL = int(os.getenv("LLM_DNS_CACHE_TTL", "300"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+# Устойчивость запросов к LLM: срок попытки до первого фрагмента ответа, общий срок ответа, повторы с джиттером
+LLM_ATTEMPT_TIMEOUT = float(os.getenv("LLM_ATTEMPT_TIMEOUT", "20"))
+LLM_STREAM_TIMEOUT = float(os.getenv("LLM_STREAM_TIMEOUT", "120"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+# После стольких ошибок подряд провайдер пропускается LLM_BREAKER_RESET секунд
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+# Дублирующий запрос, если первый фрагмент не пришел за p95 времени ответа (пока статистики нет — за LLM_HEDGE_DELAY)
+LLM_HEDGE = os.getenv("LLM_HEDGE", "0") == "1"
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "5"))
+# Запасной провайдер/модель (OpenAI-совместимый API); без LLM_FALLBACK_MODEL запасного нет
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL")
+LLM_FALLBACK_URL = os.getenv("LLM_FALLBACK_URL", DEEPSEEK_URL)
+LLM_FALLBACK_API_KEY = os.getenv("LLM_FALLBACK_API_KEY", DEEPSEEK_API_KEY)
+# Как часто дописывать ответ при потоковой генерации (Telegram ограничивает частоту правок в одном чате)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1"))
+
+# Кэш ответов на повторяющиеся вопросы (без истории диалога).
+# Поиск похожих вопросов выключен по умолчанию (0): ответы касаются здоровья, ошибка дороже лишнего запроса.
+# Если включать — порог не ниже 0.9; слова вопроса всё равно должны совпасть все
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "2000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+
+# Кэш профилей пользователей в памяти процесса (TTL ограничивает расхождение между репликами)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
+
+# Контекст диалога: бюджет истории в токенах, старые реплики сворачиваются в краткое содержание
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Сворачивание с запасом: когда история превысила бюджет, в ней остается не больше CONTEXT_LOW_WATER токенов свежих реплик,
+# поэтому следующее сворачивание нужно только через несколько вопросов, а не после каждого
+CONTEXT_LOW_WATER = int(os.getenv("CONTEXT_LOW_WATER", "500"))
+CONTEXT_FETCH_LIMIT = int(os.getenv("CONTEXT_FETCH_LIMIT", "30"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "300"))
+
+# Хранение истории сообщений: помесячные партиции старше HISTORY_RETENTION_DAYS выгружаются в архив и удаляются
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "365"))
+# По умолчанию — каталог archive в корне проекта (/app/archive в контейнере, там же volume), независимо от рабочего каталога
+HISTORY_ARCHIVE_DIR = os.getenv(
+    "HISTORY_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "archive")
+)
+HISTORY_MAX_PER_USER = int(os.getenv("HISTORY_MAX_PER_USER", "1000"))
+HISTORY_PARTITIONS_AHEAD = int(os.getenv("HISTORY_PARTITIONS_AHEAD", "2"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "86400"))
+
+# Пул соединений PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# Предел времени запроса из пула; миграции и обслуживание истории идут на отдельном соединении без него
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+# Соединение пересоздается после стольких запросов или простоя (в секундах)
+DB_MAX_QUERIES = int(os.getenv("DB_MAX_QUERIES", "50000"))
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_CONNECTION_LIFETIME", "300"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_CONNECT_ATTEMPTS = int(os.getenv("DB_CONNECT_ATTEMPTS", "10"))
+DB_CONNECT_BACKOFF_BASE = float(os.getenv("DB_CONNECT_BACKOFF_BASE", "0.5"))
+DB_CONNECT_BACKOFF_MAX = float(os.getenv("DB_CONNECT_BACKOFF_MAX", "30"))
+
+# Счетчики /stats: строки делятся на столько слотов, чтобы одновременные вопросы не ждали друг друга на одной строке
+STATS_SLOTS = int(os.getenv("STATS_SLOTS", "16"))
+# За сколько последних дней /stats показывает ряды по дням
+STATS_DAYS = int(os.getenv("STATS_DAYS", "7"))
+
+# Режим получения обновлений: polling (getUpdates) или webhook (HTTP-сервер aiohttp)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Публичный адрес, на который Telegram шлет обновления (без пути), например https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Telegram передает его в заголовке X-Telegram-Bot-Api-Secret-Token; запросы без него отклоняются
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько обновлений одна реплика обрабатывает одновременно
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "100"))
+# Сколько параллельных соединений Telegram открывает к вебхуку (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Хранилище FSM в PostgreSQL: кэш чтения и отложенная пакетная запись
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+# Сколько секунд запись в кэше считается свежей. В режиме webhook обновления одного пользователя
+# могут попасть на разные реплики, поэтому по умолчанию кэш не используется и состояние читается из БД
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "0" if BOT_MODE == "webhook" else "60"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+# Предельная пауза между повторами, если отложенная запись состояний в БД не удалась
+FSM_FLUSH_RETRY_MAX = float(os.getenv("FSM_FLUSH_RETRY_MAX", "30"))
+
+# Логи: JSON-строки в stdout, запись идет в отдельном потоке через очередь.
+# LOG_LEVELS — уровни отдельных модулей, например "broadcast=DEBUG,aiogram=WARNING"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.getenv("LOG_LEVELS", "aiogram.event=WARNING")
+# Доля сохраняемых записей ниже WARNING для шумных модулей, например "broadcast=0.01"; предупреждения и ошибки пишутся всегда
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+# Сколько записей может ждать в очереди; при переполнении новые записи отбрасываются, а не блокируют бота
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics; METRICS_PORT=0 отключает сервер
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Несколько реплик бота: роли и части рассылок раздаются через аренды в PostgreSQL.
+# Идентификатор реплики по умолчанию уникален для каждого запуска процесса
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(3)}"
+# Через сколько секунд без продления роль лидера переходит к другой реплике
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+# Рассылка делится на части по столько получателей; реплики отправляют части параллельно
+BROADCAST_SHARD_SIZE = int(os.getenv("BROADCAST_SHARD_SIZE", "1000"))
+BROADCAST_SHARD_LEASE_TTL = float(os.getenv("BROADCAST_SHARD_LEASE_TTL", "30"))
+# Как часто реплика ищет свободные части рассылок (в том числе брошенные упавшей репликой)
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+
+# Ежедневная поддержка по местному времени: отправки размазаны по окну (в минутах) после выбранного времени
+DAILY_SEND_WINDOW = int(os.getenv("DAILY_SEND_WINDOW", "60"))
+# Планировщик раз в тик забирает пользователей, у которых наступило время доставки
+DAILY_TICK_INTERVAL = float(os.getenv("DAILY_TICK_INTERVAL", "60"))
+DAILY_BATCH_SIZE = int(os.getenv("DAILY_BATCH_SIZE", "10000"))
+# Доставки, опоздавшие больше чем на столько минут (бот был выключен), пропускаются до следующего дня
+DAILY_MAX_LATENESS = int(os.getenv("DAILY_MAX_LATENESS", "60"))
+
+# Как часто (в секундах) проверять, не изменился ли daily_messages.json
+DAILY_CATALOG_CHECK_INTERVAL = float(os.getenv("DAILY_CATALOG_CHECK_INTERVAL", "30"))
+
+# Уведомления админам о вопросах и отзывах копятся и уходят дайджестом раз в ADMIN_DIGEST_INTERVAL секунд;
+# если событий больше ADMIN_DIGEST_SIZE, вместо полного текста приходит сводка
+ADMIN_DIGEST_INTERVAL = float(os.getenv("ADMIN_DIGEST_INTERVAL", "30"))
+ADMIN_DIGEST_SIZE = int(os.getenv("ADMIN_DIGEST_SIZE", "10"))
+ADMIN_QUEUE_LIMIT = int(os.getenv("ADMIN_QUEUE_LIMIT", "1000"))
+
+# Сообщения пользователя, пришедшие в пределах QUESTION_DEBOUNCE секунд (или пока готовится ответ), склеиваются в один вопрос
+QUESTION_DEBOUNCE = float(os.getenv("QUESTION_DEBOUNCE", "0.8"))
+QUESTION_MAX_PENDING = int(os.getenv("QUESTION_MAX_PENDING", "5"))
+# Общий лимит одновременных запросов к DeepSeek на реплику и длина очереди к нему
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "20"))
+LLM_MAX_WAITING = int(os.getenv("LLM_MAX_WAITING", "50"))
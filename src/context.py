@@ -0,0 +1,56 @@
+import math
+
+from config import CONTEXT_TOKEN_BUDGET, CONTEXT_LOW_WATER
+from database import save_conversation_summary
+
+# Грубая локальная оценка: для русского текста токенизатор DeepSeek дает примерно токен на 3 символа
+CHARS_PER_TOKEN = 3.0
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Пользователи, для которых сейчас готовится краткое содержание: не больше одного запроса на пользователя
+_summarizing = set()
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценить число токенов без вызова токенизатора"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN) + MESSAGE_OVERHEAD_TOKENS
+
+
+def _fit(history, used, budget):
+    """Индекс первой реплики, с которой свежие реплики помещаются в бюджет"""
+    kept = len(history)
+    for index in range(len(history) - 1, -1, -1):
+        used += estimate_tokens(history[index]['content'])
+        if used > budget:
+            break
+        kept = index
+    return kept
+
+
+def fit_history(history, summary=None, budget=CONTEXT_TOKEN_BUDGET, low_water=CONTEXT_LOW_WATER):
+    """Разделить историю на свежие реплики для промпта (в пределах budget) и старые, которые нужно свернуть.
+    Сворачивать нужно, только когда история не поместилась в budget, и тогда — до low_water токенов свежих реплик.
+    Возвращает (реплики для промпта, реплики для сворачивания в summary или []); обе части от старых к новым"""
+    used = estimate_tokens(summary) if summary else 0
+    kept = _fit(history, used, budget)
+    if not kept:
+        return history, []
+    return history[kept:], history[:_fit(history, used, max(low_water, used))]
+
+
+async def refresh_summary(pool, llm, user_id, summary, overflow):
+    """Свернуть вытесненные из бюджета реплики в сжатое содержание диалога (в фоне, после ответа).
+    Пропускается, если для пользователя сворачивание уже идет или все слоты LLM заняты ответами:
+    реплики останутся несвернутыми, и попытка повторится со следующим вопросом"""
+    if user_id in _summarizing or llm.busy:
+        return
+    _summarizing.add(user_id)
+    try:
+        new_summary = await llm.summarize(summary, overflow)
+        if not new_summary:
+            return
+        async with pool.acquire() as conn:
+            await save_conversation_summary(conn, user_id, new_summary, overflow[-1]['id'])
+    finally:
+        _summarizing.discard(user_id)
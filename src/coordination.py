@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import time
+
+from config import REPLICA_ID, LEADER_LEASE_TTL
+from database import acquire_lease, release_lease
+from metrics import lease_errors
+
+logger = logging.getLogger(__name__)
+
+
+class Lease:
+    """Роль, которую в каждый момент выполняет одна реплика (например, планировщик).
+    Аренда продлевается каждую треть ttl; если реплика упала, через ttl роль забирает другая"""
+
+    def __init__(self, pool, name, holder=REPLICA_ID, ttl=LEADER_LEASE_TTL):
+        self.pool = pool
+        self.name = name
+        self.holder = holder
+        self.ttl = ttl
+        self._valid_until = 0.0
+
+    @property
+    def held(self):
+        # Срок считается локально от момента запроса: если продлить аренду не удалось, роль отпускается сама
+        return time.monotonic() < self._valid_until
+
+    async def keep(self):
+        """Фоновая задача: захватывать и продлевать аренду"""
+        while True:
+            started = time.monotonic()
+            try:
+                async with self.pool.acquire() as conn:
+                    acquired = await acquire_lease(conn, self.name, self.holder, self.ttl)
+                self._valid_until = started + self.ttl if acquired else 0.0
+            except Exception as e:
+                # Роль остается до конца срока аренды и отпускается сама, если продлить так и не удастся
+                lease_errors.inc(lease=self.name, error=type(e).__name__)
+                logger.warning("Не удалось продлить аренду %s", self.name, exc_info=True)
+            await asyncio.sleep(self.ttl / 3)
+
+    async def release(self):
+        if not self.held:
+            return
+        self._valid_until = 0.0
+        async with self.pool.acquire() as conn:
+            await release_lease(conn, self.name, self.holder)
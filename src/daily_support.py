@@ -1,50 +1,187 @@
 import json
 import os
-from datetime import datetime, date
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import date
+
+from config import DAILY_CATALOG_CHECK_INTERVAL
 
 DAILY_MESSAGES_FILE = os.path.join(os.path.dirname(__file__), 'daily_messages.json')
+DEFAULT_MESSAGE = "Ты не одна, и всё в порядке."
+# Для скольких пользователей помнить позицию сообщений по кнопке (остальные начинают заново)
+ON_DEMAND_CURSORS = 50000
+
+# Веса тем ежедневной поддержки для каждого периода; темы, которых нет в списке, получают вес 1
+PERIOD_THEME_WEIGHTS = {
+    "готовлюсь": {
+        "забота о себе": 3,
+        "мотивация, вдохновение, вера в себя": 3,
+        "индивидуальность и принятие себя": 2,
+        "поддержка и понимание": 2,
+    },
+    "беременна": {
+        "забота о себе": 3,
+        "тепло материнской любви": 3,
+        "поддержка и понимание": 2,
+        "усталость и забота о себе в этот период": 2,
+    },
+    "ребенку меньше года": {
+        "усталость и забота о себе в этот период": 3,
+        "терпение, стойкость и забота": 3,
+        "тепло материнской любви": 2,
+        "забота о себе": 2,
+        "маленькие шаги и ежедневные победы": 2,
+    },
+    "ребенку 2-3": {
+        "терпение, стойкость и забота": 3,
+        "маленькие шаги и ежедневные победы": 3,
+        "тепло материнской любви": 2,
+        "поддержка и понимание": 2,
+    },
+    "ребенку 3+": {
+        "индивидуальность и принятие себя": 3,
+        "мотивация, вдохновение, вера в себя": 3,
+        "тепло материнской любви": 2,
+        "забота о себе": 2,
+    },
+}
+
+class MessageCatalog:
+    """Ежедневные сообщения в памяти: все темы в одном кортеже, у каждой темы — диапазон индексов.
+    Файл перечитывается только при изменении mtime (проверка не чаще раза в check_interval секунд)"""
+
+    def __init__(self, path=DAILY_MESSAGES_FILE, check_interval=DAILY_CATALOG_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.messages = ()
+        # (название темы, первый индекс, индекс после последнего) в self.messages
+        self.themes = ()
+        # -1 — каталог еще не загружался (None — файла нет)
+        self._mtime = -1
+        self._checked_at = None
+        self._today = None
+        # period -> (накопленные веса, индексы тем) для выбора темы
+        self._period_tables = {}
+        # user_id -> (seen, count) сообщений по кнопке: своя ротация в памяти, в БД не пишется
+        self._on_demand = OrderedDict()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        messages = []
+        themes = []
+        for theme in data.get('themes', []):
+            start = len(messages)
+            messages.extend(theme.get('messages', []))
+            themes.append((theme.get('name', ''), start, len(messages)))
+        self.messages = tuple(messages)
+        self.themes = tuple(themes)
+        self._today = None
+        self._period_tables = {}
+
+    def refresh(self):
+        """Перечитать файл, если он изменился с прошлой загрузки"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        try:
+            self.load()
+        except json.JSONDecodeError:
+            # Файл записывается прямо сейчас: оставляем прежний каталог и пробуем при следующей проверке
+            return
+        self._mtime = mtime
+
+    def today_message(self, day=None):
+        """Сообщение на день (одно и то же в течение дня); вычисляется один раз в сутки"""
+        self.refresh()
+        day = day or date.today()
+        if self._today is not None and self._today[0] == day:
+            return self._today[1]
+        if not self.messages:
+            return DEFAULT_MESSAGE
+        # Используем номер дня года для выбора сообщения (чтобы было одно и то же в течение дня)
+        day_of_year = day.timetuple().tm_yday  # День года (1-365/366)
+        message = self.messages[(day_of_year - 1) % len(self.messages)]
+        self._today = (day, message)
+        return message
 
-def load_daily_messages():
-    """Загрузить данные о ежедневных сообщениях"""
-    try:
-        with open(DAILY_MESSAGES_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # Если файл не найден, создаем базовую структуру
-        default_data = {
-            "current_day": 0,
-            "themes": []
-        }
-        save_daily_messages(default_data)
-        return default_data
-
-def save_daily_messages(data):
-    """Сохранить данные о ежедневных сообщениях"""
-    with open(DAILY_MESSAGES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    def _theme_table(self, period):
+        table = self._period_tables.get(period)
+        if table is None:
+            weights = PERIOD_THEME_WEIGHTS.get(period, {})
+            cumulative, indexes, total = [], [], 0
+            for index, (name, start, end) in enumerate(self.themes):
+                if end > start:
+                    total += weights.get(name, 1)
+                    cumulative.append(total)
+                    indexes.append(index)
+            table = self._period_tables[period] = (cumulative, indexes)
+        return table
+
+    def pick(self, user_id, period, seen, count):
+        """Следующее сообщение ротации пользователя.
+        seen — битовая маска показанных сообщений (bytes, бит i — self.messages[i]), count — сколько уже отправлено.
+        Внутри темы сообщения не повторяются, пока тема не показана целиком. Возвращает (сообщение, seen, count)"""
+        cumulative, indexes = self._theme_table(period)
+        if not cumulative:
+            return DEFAULT_MESSAGE, seen, count + 1
+
+        # Детерминированный псевдослучайный выбор темы по весам: у каждого пользователя свой порядок
+        mixed = (user_id * 0x9E3779B1 + count) & 0xFFFFFFFF
+        mixed = ((mixed ^ mixed >> 16) * 0x85EBCA6B) & 0xFFFFFFFF
+        mixed = ((mixed ^ mixed >> 13) * 0xC2B2AE35) & 0xFFFFFFFF
+        mixed ^= mixed >> 16
+        name, start, end = self.themes[indexes[bisect_right(cumulative, mixed % cumulative[-1])]]
+
+        # Маска обрезается по размеру каталога: после правки файла лишние биты не мешают
+        bits = int.from_bytes(seen, 'little') & ((1 << len(self.messages)) - 1)
+        theme_mask = ((1 << (end - start)) - 1) << start
+        if bits & theme_mask == theme_mask:
+            # Тема показана целиком — начинаем её заново
+            bits &= ~theme_mask
+        size = end - start
+        offset = user_id % size
+        for step in range(size):
+            index = start + (offset + step) % size
+            if not bits >> index & 1:
+                break
+        bits |= 1 << index
+        return self.messages[index], bits.to_bytes((len(self.messages) + 7) // 8, 'little'), count + 1
+
+    def on_demand(self, user_id, period):
+        """Сообщение по кнопке «Получить порцию поддержки»: та же ротация по темам периода, но с отдельной позицией
+        в памяти, поэтому ежедневная ротация пользователя не сдвигается и БД не нужна"""
+        self.refresh()
+        seen, count = self._on_demand.pop(user_id, (b'', 0))
+        message, seen, count = self.pick(user_id, period, seen, count)
+        self._on_demand[user_id] = (seen, count)
+        if len(self._on_demand) > ON_DEMAND_CURSORS:
+            self._on_demand.popitem(last=False)
+        return message
+
+    def render(self, users):
+        """Сообщения для пачки пользователей за один проход: users — записи (user_id, period, support_seen, support_count).
+        Возвращает список (user_id, сообщение, новая маска, новый счетчик)"""
+        self.refresh()
+        rendered = []
+        for user_id, period, seen, count in users:
+            message, seen, count = self.pick(user_id, period, seen, count)
+            rendered.append((user_id, message, seen, count))
+        return rendered
+
+catalog = MessageCatalog()
 
 def get_today_message():
     """Получить сообщение на сегодня (одно и то же в течение дня)"""
-    data = load_daily_messages()
-    
-    if not data.get('themes'):
-        return "Ты не одна, и всё в порядке."
-    
-    # Получаем все сообщения из всех тем
-    all_messages = []
-    for theme in data['themes']:
-        all_messages.extend(theme.get('messages', []))
-    
-    if not all_messages:
-        return "Ты не одна, и всё в порядке."
-    
-    # Используем номер дня года для выбора сообщения (чтобы было одно и то же в течение дня)
-    today = date.today()
-    day_of_year = today.timetuple().tm_yday  # День года (1-365/366)
-    
-    # Выбираем сообщение на основе дня года
-    message_index = (day_of_year - 1) % len(all_messages)
-    message = all_messages[message_index]
-    
-    return message
-
+    return catalog.today_message()
@@ -1,164 +1,673 @@
 import asyncpg
 import asyncio
-from config import DB_URL
+import functools
+import json
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from config import (
+    DB_URL, DELIVERY_FAILURE_LIMIT, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_COMMAND_TIMEOUT, DB_MAX_QUERIES,
+    DB_MAX_INACTIVE_CONNECTION_LIFETIME, DB_STATEMENT_CACHE_SIZE, DB_ACQUIRE_TIMEOUT,
+    DB_CONNECT_ATTEMPTS, DB_CONNECT_BACKOFF_BASE, DB_CONNECT_BACKOFF_MAX, BROADCAST_SHARD_SIZE,
+    DAILY_SEND_WINDOW, DAILY_BATCH_SIZE, DAILY_MAX_LATENESS, STATS_SLOTS, STATS_DAYS
+)
+from metrics import db_acquire_seconds, db_query_seconds, db_pool_connections
+from migrate import migrate
+
+logger = logging.getLogger(__name__)
+
+class TimedPool:
+    """Обертка над пулом asyncpg: ограничивает ожидание соединения и измеряет его"""
+
+    def __init__(self, pool):
+        self._pool = pool
+        # Размер пула читается при экспорте метрик
+        db_pool_connections.track(pool.get_size, state='open')
+        db_pool_connections.track(pool.get_idle_size, state='idle')
+        db_pool_connections.track(pool.get_max_size, state='max')
+
+    def acquire(self):
+        return _TimedAcquire(self._pool)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+class _TimedAcquire:
+    def __init__(self, pool):
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        self._conn = await self._pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+        db_acquire_seconds.observe(time.perf_counter() - started)
+        return self._conn
+
+    async def __aexit__(self, *exc):
+        await self._pool.release(self._conn)
 
 async def create_db_pool():
-    max_attempts = 10
+    """Создать пул соединений; при недоступности БД повторять с экспоненциальной задержкой"""
     attempt = 0
     
-    while attempt < max_attempts:
+    while True:
         try:
-            pool = await asyncpg.create_pool(DB_URL)
-            #print("Successfully connected to PostgreSQL")
-            return pool
+            pool = await asyncpg.create_pool(
+                DB_URL,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                command_timeout=DB_COMMAND_TIMEOUT,
+                max_queries=DB_MAX_QUERIES,
+                max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+                # Каждый запрос готовится (PREPARE) один раз на соединение и берется из кэша asyncpg;
+                # кэш переживает возврат соединения в пул, поэтому размер должен вмещать все запросы database.py
+                statement_cache_size=DB_STATEMENT_CACHE_SIZE
+            )
+            logger.info("Successfully connected to PostgreSQL")
+            return TimedPool(pool)
         except Exception as e:
             attempt += 1
-            #print(f"Connection attempt {attempt} failed: {e}")
-            if attempt >= max_attempts:
+            logger.warning("Connection attempt %s failed: %s", attempt, e)
+            if attempt >= DB_CONNECT_ATTEMPTS:
                 raise e
-            await asyncio.sleep(2)  # Wait 2 seconds before retrying
-
-async def init_db(pool):
-    async with pool.acquire() as conn:
-        # Создаем таблицу пользователей с полем для подсчета вопросов
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT UNIQUE NOT NULL,
-                username VARCHAR(255),
-                full_name VARCHAR(255),
-                name VARCHAR(255),
-                period VARCHAR(255),
-                question_count INTEGER DEFAULT 0,
-                daily_support_enabled BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Добавляем колонку daily_support_enabled, если её нет (для существующих БД)
-        column_exists = await conn.fetchval('''
-            SELECT EXISTS (
-                SELECT 1 
-                FROM information_schema.columns 
-                WHERE table_name = 'users' 
-                AND column_name = 'daily_support_enabled'
-            )
-        ''')
-        
-        if not column_exists:
-            await conn.execute('''
-                ALTER TABLE users 
-                ADD COLUMN daily_support_enabled BOOLEAN DEFAULT FALSE
-            ''')
-            #print("Added daily_support_enabled column to users table")
-        
-        # Создаем таблицу для хранения истории сообщений (для контекста диалога)
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS message_history (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT NOT NULL,
-                role VARCHAR(10) NOT NULL,
-                content TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Создаем индекс для быстрого поиска истории пользователя
-        await conn.execute('''
-            CREATE INDEX IF NOT EXISTS idx_message_history_user_id 
-            ON message_history(user_id, created_at DESC)
-        ''')
-        
-        #print("Database tables checked successfully")
+            # Экспоненциальная задержка с джиттером, чтобы реплики не переподключались синхронно
+            delay = min(DB_CONNECT_BACKOFF_MAX, DB_CONNECT_BACKOFF_BASE * 2 ** (attempt - 1))
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+def timed(func):
+    """Записать время выполнения функции доступа к данным в гистограмму db_query_seconds"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with db_query_seconds.time(query=func.__name__):
+            return await func(*args, **kwargs)
+    return wrapper
+
+@asynccontextmanager
+async def maintenance_connection():
+    """Отдельное соединение без DB_COMMAND_TIMEOUT (он действует на все запросы пула, даже с timeout=None):
+    для миграций, ожидания их блокировки и обслуживания истории, которые идут дольше запросов обработчиков"""
+    conn = await asyncpg.connect(DB_URL)
+    try:
+        yield conn
+    finally:
+        await conn.close()
+
+async def init_db():
+    """Привести схему БД к актуальной версии (см. migrate.py и каталог migrations)"""
+    async with maintenance_connection() as conn:
+        await migrate(conn)
 
+# Счетчики stats_period и stats_daily (миграция 0009) меняются в тех же запросах, что и users.
+# Старые значения строки берутся через SELECT ... FOR UPDATE в CTE: RETURNING отдает только новые
+
+@timed
 async def save_user(conn, user_id, username, full_name, name):
     await conn.execute(
-        "INSERT INTO users (user_id, username, full_name, name) VALUES ($1, $2, $3, $4) ON CONFLICT (user_id) DO UPDATE SET name = $4",
-        user_id, username, full_name, name
+        """
+        WITH saved AS (
+            INSERT INTO users (user_id, username, full_name, name) VALUES ($1, $2, $3, $4)
+            ON CONFLICT (user_id) DO UPDATE SET name = $4
+            -- xmax = 0 только у только что вставленной строки
+            RETURNING (xmax = 0) AS inserted, COALESCE(period, '') AS period
+        ), totals AS (
+            INSERT INTO stats_period (period, slot, users)
+            SELECT period, $1 % $5, 1 FROM saved WHERE inserted
+            ON CONFLICT (period, slot) DO UPDATE SET users = stats_period.users + 1
+        )
+        INSERT INTO stats_daily (day, slot, new_users)
+        SELECT CURRENT_DATE, $1 % $5, 1 FROM saved WHERE inserted
+        ON CONFLICT (day, slot) DO UPDATE SET new_users = stats_daily.new_users + 1
+        """,
+        user_id, username, full_name, name, STATS_SLOTS
     )
 
+@timed
 async def update_user_period(conn, user_id, period):
+    """Сменить период; пользователь, его вопросы и подписка переносятся в счетчики нового периода"""
     await conn.execute(
-        "UPDATE users SET period = $1 WHERE user_id = $2",
-        period, user_id
-    )
-
-async def increment_question_count(conn, user_id):
-    await conn.execute(
-        "UPDATE users SET question_count = question_count + 1 WHERE user_id = $1",
-        user_id
+        """
+        WITH old AS (
+            SELECT user_id, COALESCE(period, '') AS period, COALESCE(question_count, 0) AS questions,
+                   COALESCE(daily_support_enabled, FALSE) AS subscribed
+            FROM users WHERE user_id = $2
+            FOR UPDATE
+        ), changed AS (
+            UPDATE users AS u SET period = $1
+            FROM old
+            WHERE u.user_id = old.user_id
+            RETURNING old.period AS old_period, old.questions, old.subscribed
+        )
+        INSERT INTO stats_period AS s (period, slot, users, questions, subscribers)
+        SELECT delta.period, $2 % $3, delta.sign, delta.sign * changed.questions, delta.sign * changed.subscribed::int
+        FROM changed
+        CROSS JOIN LATERAL (VALUES (changed.old_period, -1), (COALESCE($1, ''), 1)) AS delta(period, sign)
+        WHERE changed.old_period <> COALESCE($1, '')
+        ON CONFLICT (period, slot) DO UPDATE SET
+            users = s.users + EXCLUDED.users,
+            questions = s.questions + EXCLUDED.questions,
+            subscribers = s.subscribers + EXCLUDED.subscribers
+        """,
+        period, user_id, STATS_SLOTS
     )
 
+@timed
 async def get_stats(conn):
-    user_count = await conn.fetchval("SELECT COUNT(*) FROM users")
-    total_questions = await conn.fetchval("SELECT SUM(question_count) FROM users")
-    return user_count, total_questions
+    """Всего пользователей, вопросов и подписчиков поддержки (сумма слотов stats_period, без обхода users)"""
+    row = await conn.fetchrow(
+        """
+        SELECT COALESCE(SUM(users), 0)::bigint AS users, COALESCE(SUM(questions), 0)::bigint AS questions,
+               COALESCE(SUM(subscribers), 0)::bigint AS subscribers
+        FROM stats_period
+        """
+    )
+    return row['users'], row['questions'], row['subscribers']
 
+@timed
 async def get_period_stats(conn):
     return await conn.fetch("""
         SELECT 
             period,
-            COUNT(*) as user_count,
-            SUM(question_count) as total_questions  -- Добавляем суммарное количество вопросов
-        FROM users 
-        WHERE period IS NOT NULL
+            SUM(users)::bigint as user_count,
+            SUM(questions)::bigint as total_questions
+        FROM stats_period
+        WHERE period <> ''
         GROUP BY period
+        HAVING SUM(users) > 0
         ORDER BY user_count DESC
     """)
+
+@timed
+async def get_daily_stats(conn, days=STATS_DAYS):
+    """Ряды по дням за последние days дней (дни без событий — нулями), от старых к новым"""
+    return await conn.fetch(
+        """
+        SELECT d.day::date AS day,
+               COALESCE(SUM(s.new_users), 0) AS new_users,
+               COALESCE(SUM(s.active_users), 0) AS active_users,
+               COALESCE(SUM(s.questions), 0) AS questions,
+               COALESCE(SUM(s.subscribed), 0) AS subscribed,
+               COALESCE(SUM(s.unsubscribed), 0) AS unsubscribed,
+               COALESCE(SUM(s.blocked), 0) AS blocked,
+               COALESCE(SUM(s.returned), 0) AS returned
+        FROM generate_series(CURRENT_DATE - ($1::int - 1), CURRENT_DATE, INTERVAL '1 day') AS d(day)
+        LEFT JOIN stats_daily s ON s.day = d.day::date
+        GROUP BY d.day
+        ORDER BY d.day
+        """,
+        days
+    )
     
-    # database.py
-async def get_user_data(conn, user_id):
+@timed
+async def get_user_profile(conn, user_id):
+    """Получить данные пользователя, нужные обработчикам: имя, период, подписка, время поддержки и число вопросов"""
     row = await conn.fetchrow(
-        "SELECT name, period FROM users WHERE user_id = $1",
+        """
+        SELECT name, period, daily_support_enabled, timezone, delivery_time, question_count
+        FROM users WHERE user_id = $1
+        """,
         user_id
     )
     return dict(row) if row else None
 
+@timed
 async def get_all_user_ids(conn):
-    """Получить список всех user_id из базы данных"""
-    rows = await conn.fetch("SELECT user_id FROM users")
+    """Получить список user_id всех пользователей, доступных для рассылки"""
+    rows = await conn.fetch(
+        "SELECT user_id FROM users WHERE blocked_at IS NULL AND delivery_failures < $1",
+        DELIVERY_FAILURE_LIMIT
+    )
     return [row['user_id'] for row in rows]
 
-async def save_message_to_history(conn, user_id, role, content):
-    """Сохранить сообщение в историю диалога"""
+@timed
+async def start_question(conn, user_id, history_limit=10):
+    """Увеличить счетчик вопросов и получить контекст диалога одним запросом.
+    Возвращает (новое значение question_count, сжатое содержание или None, несвернутая история от старых к новым)"""
+    rows = await conn.fetch(
+        """
+        WITH counter AS (
+            UPDATE users SET question_count = question_count + 1
+            WHERE user_id = $1
+            RETURNING question_count, COALESCE(period, '') AS period
+        ), totals AS (
+            INSERT INTO stats_period (period, slot, questions)
+            SELECT period, $1 % $3, 1 FROM counter
+            ON CONFLICT (period, slot) DO UPDATE SET questions = stats_period.questions + 1
+        ), daily AS (
+            INSERT INTO stats_daily (day, slot, questions)
+            SELECT CURRENT_DATE, $1 % $3, 1 FROM counter
+            ON CONFLICT (day, slot) DO UPDATE SET questions = stats_daily.questions + 1
+        )
+        SELECT c.question_count, s.summary, h.id, h.role, h.content
+        FROM counter c
+        LEFT JOIN conversation_summaries s ON s.user_id = $1
+        LEFT JOIN LATERAL (
+            SELECT id, role, content, created_at
+            FROM message_history
+            WHERE user_id = $1 AND id > COALESCE(s.summarized_until_id, 0)
+            ORDER BY created_at DESC, id DESC
+            LIMIT $2
+        ) h ON TRUE
+        ORDER BY h.created_at, h.id
+        """,
+        user_id, history_limit, STATS_SLOTS
+    )
+    if not rows:
+        return None, None, []
+    history = [
+        {"id": row['id'], "role": row['role'], "content": row['content']}
+        for row in rows if row['role'] is not None
+    ]
+    return rows[0]['question_count'], rows[0]['summary'], history
+
+@timed
+async def save_dialog_turn(conn, user_id, question, answer):
+    """Сохранить вопрос и ответ в историю одним INSERT (порядок внутри пары задает id)"""
+    await conn.execute(
+        "INSERT INTO message_history (user_id, role, content) VALUES ($1, 'user', $2), ($1, 'assistant', $3)",
+        user_id, question, answer
+    )
+
+@timed
+async def claim_due_daily_deliveries(conn, limit=DAILY_BATCH_SIZE, window=DAILY_SEND_WINDOW, max_lateness=DAILY_MAX_LATENESS):
+    """Забрать подписчиков, у которых наступило время ежедневной поддержки, и сразу назначить им следующую доставку.
+    Возвращает тех, кому нужно отправить сообщение сейчас (без сильного опоздания и без серии неудачных доставок),
+    вместе с данными для выбора сообщения: (user_id, period, support_seen, support_count)"""
+    rows = await conn.fetch(
+        """
+        WITH due AS (
+            SELECT user_id, next_delivery_at, delivery_failures, period, support_seen, support_count
+            FROM users
+            WHERE daily_support_enabled AND blocked_at IS NULL AND next_delivery_at <= CURRENT_TIMESTAMP
+            ORDER BY next_delivery_at
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        ), moved AS (
+            UPDATE users AS u
+            SET next_delivery_at = next_daily_delivery(u.timezone, u.delivery_time, u.user_id, $2, CURRENT_TIMESTAMP)
+            FROM due
+            WHERE u.user_id = due.user_id
+        )
+        SELECT user_id, period, support_seen, support_count FROM due
+        WHERE delivery_failures < $3
+          AND next_delivery_at > CURRENT_TIMESTAMP - make_interval(mins => $4)
+        """,
+        limit, window, DELIVERY_FAILURE_LIMIT, max_lateness
+    )
+    return [tuple(row) for row in rows]
+
+@timed
+async def save_support_rotation(conn, rotations):
+    """Сохранить позиции ротации ежедневной поддержки пачкой: rotations — список (user_id, support_seen, support_count)"""
+    await conn.execute(
+        """
+        UPDATE users AS u
+        SET support_seen = r.seen, support_count = r.count
+        FROM unnest($1::bigint[], $2::bytea[], $3::integer[]) AS r(user_id, seen, count)
+        WHERE u.user_id = r.user_id
+        """,
+        [user_id for user_id, _, _ in rotations],
+        [seen for _, seen, _ in rotations],
+        [count for _, _, count in rotations]
+    )
+
+@timed
+async def toggle_daily_support(conn, user_id, enabled):
+    """Включить/выключить ежедневную поддержку для пользователя; подписки и отписки попадают в stats_daily"""
+    await conn.execute(
+        """
+        WITH old AS (
+            SELECT user_id, COALESCE(period, '') AS period, COALESCE(daily_support_enabled, FALSE) AS enabled
+            FROM users WHERE user_id = $2
+            FOR UPDATE
+        ), changed AS (
+            UPDATE users AS u
+            SET daily_support_enabled = $1,
+                next_delivery_at = CASE WHEN $1
+                    THEN next_daily_delivery(u.timezone, u.delivery_time, u.user_id, $3, CURRENT_TIMESTAMP)
+                END
+            FROM old
+            WHERE u.user_id = old.user_id
+            RETURNING old.period, old.enabled AS was_enabled
+        ), totals AS (
+            INSERT INTO stats_period (period, slot, subscribers)
+            SELECT period, $2 % $4, CASE WHEN $1 THEN 1 ELSE -1 END FROM changed WHERE was_enabled <> $1
+            ON CONFLICT (period, slot) DO UPDATE SET subscribers = stats_period.subscribers + EXCLUDED.subscribers
+        )
+        INSERT INTO stats_daily (day, slot, subscribed, unsubscribed)
+        SELECT CURRENT_DATE, $2 % $4, $1::int, (NOT $1)::int FROM changed WHERE was_enabled <> $1
+        ON CONFLICT (day, slot) DO UPDATE SET
+            subscribed = stats_daily.subscribed + EXCLUDED.subscribed,
+            unsubscribed = stats_daily.unsubscribed + EXCLUDED.unsubscribed
+        """,
+        enabled, user_id, DAILY_SEND_WINDOW, STATS_SLOTS
+    )
+
+@timed
+async def set_daily_delivery_time(conn, user_id, timezone, delivery_time):
+    """Сохранить часовой пояс и время ежедневной поддержки; следующая доставка пересчитывается сразу"""
+    await conn.execute(
+        """
+        UPDATE users
+        SET timezone = $2::text, delivery_time = $3,
+            next_delivery_at = CASE WHEN daily_support_enabled
+                THEN next_daily_delivery($2::text, $3, user_id, $4, CURRENT_TIMESTAMP)
+            END
+        WHERE user_id = $1
+        """,
+        user_id, timezone, delivery_time, DAILY_SEND_WINDOW
+    )
+
+@timed
+async def create_broadcast_job(conn, kind, payload, user_ids, status_chat_id=None, status_message_id=None,
+                               shard_size=BROADCAST_SHARD_SIZE, payloads=None):
+    """Создать задание рассылки со списком получателей.
+    payloads — свой payload для каждого получателя (в порядке user_ids) вместо общего"""
+    async with conn.transaction():
+        job_id = await conn.fetchval(
+            """
+            INSERT INTO broadcast_jobs (kind, payload, status_chat_id, status_message_id)
+            VALUES ($1, $2::jsonb, $3, $4)
+            RETURNING id
+            """,
+            kind, json.dumps(payload), status_chat_id, status_message_id
+        )
+        if payloads is None:
+            await conn.execute(
+                "INSERT INTO broadcast_deliveries (job_id, user_id) SELECT $1, unnest($2::bigint[])",
+                job_id, user_ids
+            )
+        else:
+            await conn.execute(
+                """
+                INSERT INTO broadcast_deliveries (job_id, user_id, payload)
+                SELECT $1, r.user_id, r.payload::jsonb
+                FROM unnest($2::bigint[], $3::text[]) AS r(user_id, payload)
+                """,
+                job_id, user_ids, [json.dumps(item) for item in payloads]
+            )
+        # Части по shard_size получателей подряд по user_id: реплики отправляют их параллельно
+        await conn.execute(
+            """
+            INSERT INTO broadcast_shards (job_id, shard, first_user_id, last_user_id)
+            SELECT $1, (rn - 1) / $2, MIN(user_id), MAX(user_id)
+            FROM (
+                SELECT user_id, row_number() OVER (ORDER BY user_id) AS rn
+                FROM broadcast_deliveries
+                WHERE job_id = $1
+            ) d
+            GROUP BY (rn - 1) / $2
+            """,
+            job_id, shard_size
+        )
+    return job_id
+
+@timed
+async def get_broadcast_job(conn, job_id):
+    """Получить задание рассылки"""
+    row = await conn.fetchrow("SELECT * FROM broadcast_jobs WHERE id = $1", job_id)
+    if not row:
+        return None
+    job = dict(row)
+    job['payload'] = json.loads(job['payload'])
+    return job
+
+@timed
+async def claim_broadcast_shard(conn, holder, lease_seconds, job_id=None):
+    """Взять в аренду свободную часть рассылки (любого задания или только job_id).
+    Возвращает (job_id, shard, first_user_id, last_user_id) или None, если свободных частей нет"""
+    row = await conn.fetchrow(
+        """
+        UPDATE broadcast_shards AS s
+        SET holder = $1, lease_until = CURRENT_TIMESTAMP + make_interval(secs => $2)
+        FROM (
+            SELECT job_id, shard
+            FROM broadcast_shards
+            WHERE NOT done
+              AND (lease_until IS NULL OR lease_until < CURRENT_TIMESTAMP)
+              AND ($3::integer IS NULL OR job_id = $3)
+            ORDER BY job_id, shard
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        ) AS free
+        WHERE s.job_id = free.job_id AND s.shard = free.shard
+        RETURNING s.job_id, s.shard, s.first_user_id, s.last_user_id
+        """,
+        holder, lease_seconds, job_id
+    )
+    return tuple(row) if row else None
+
+@timed
+async def renew_broadcast_shard(conn, job_id, shard, holder, lease_seconds):
+    """Продлить аренду части. False — часть уже забрала другая реплика"""
+    renewed = await conn.fetchval(
+        """
+        UPDATE broadcast_shards
+        SET lease_until = CURRENT_TIMESTAMP + make_interval(secs => $4)
+        WHERE job_id = $1 AND shard = $2 AND holder = $3 AND NOT done
+        RETURNING shard
+        """,
+        job_id, shard, holder, lease_seconds
+    )
+    return renewed is not None
+
+@timed
+async def release_broadcast_shard(conn, job_id, shard, holder, done):
+    """Отпустить часть: отметить отправленной или вернуть другим репликам сразу, не дожидаясь истечения аренды"""
     await conn.execute(
-        "INSERT INTO message_history (user_id, role, content) VALUES ($1, $2, $3)",
-        user_id, role, content
+        """
+        UPDATE broadcast_shards
+        SET done = $4, lease_until = NULL
+        WHERE job_id = $1 AND shard = $2 AND holder = $3
+        """,
+        job_id, shard, holder, done
+    )
+
+@timed
+async def count_open_broadcast_shards(conn, job_id):
+    """Количество еще не отправленных частей задания"""
+    return await conn.fetchval(
+        "SELECT COUNT(*) FROM broadcast_shards WHERE job_id = $1 AND NOT done",
+        job_id
     )
 
-async def get_message_history(conn, user_id, limit=10):
-    """Получить последние N сообщений из истории диалога"""
+@timed
+async def get_pending_deliveries(conn, job_id, first_user_id, last_user_id):
+    """Получить получателей из диапазона user_id, которым сообщение еще не отправлено.
+    Возвращает пары (user_id, свой payload получателя или None)"""
     rows = await conn.fetch(
         """
-        SELECT role, content 
-        FROM message_history 
-        WHERE user_id = $1 
-        ORDER BY created_at DESC 
-        LIMIT $2
+        SELECT user_id, payload FROM broadcast_deliveries
+        WHERE job_id = $1 AND user_id BETWEEN $2 AND $3 AND status = 'pending'
+        ORDER BY user_id
         """,
-        user_id, limit
+        job_id, first_user_id, last_user_id
     )
-    # Возвращаем в обратном порядке (от старых к новым)
-    return list(reversed([{"role": row['role'], "content": row['content']} for row in rows]))
+    return [(row['user_id'], json.loads(row['payload']) if row['payload'] else None) for row in rows]
 
-async def get_users_with_daily_support(conn):
-    """Получить список пользователей с включенной ежедневной поддержкой"""
+@timed
+async def get_delivery_counts(conn, job_id):
+    """Получить количество доставок задания по статусам"""
     rows = await conn.fetch(
-        "SELECT user_id FROM users WHERE daily_support_enabled = TRUE"
+        "SELECT status, COUNT(*) AS count FROM broadcast_deliveries WHERE job_id = $1 GROUP BY status",
+        job_id
     )
-    return [row['user_id'] for row in rows]
+    return {row['status']: row['count'] for row in rows}
 
-async def is_daily_support_enabled(conn, user_id):
-    """Проверить, включена ли ежедневная поддержка для пользователя"""
-    result = await conn.fetchval(
-        "SELECT daily_support_enabled FROM users WHERE user_id = $1",
-        user_id
+@timed
+async def save_delivery_results(conn, job_id, results):
+    """Сохранить результаты доставки пачкой: results — список пар (user_id, status)"""
+    await conn.execute(
+        """
+        UPDATE broadcast_deliveries AS d
+        SET status = r.status
+        FROM unnest($2::bigint[], $3::varchar[]) AS r(user_id, status)
+        WHERE d.job_id = $1 AND d.user_id = r.user_id
+        """,
+        job_id, [user_id for user_id, _ in results], [status for _, status in results]
     )
-    return result if result is not None else False
 
-async def toggle_daily_support(conn, user_id, enabled):
-    """Включить/выключить ежедневную поддержку для пользователя"""
+@timed
+async def save_user_delivery_state(conn, results):
+    """Обновить состояние доставки пользователей по результатам рассылки: results — список пар (user_id, status).
+    В DELIVERY_FAILURE_LIMIT идут только ошибки получателя ('blocked', 'unreachable')"""
     await conn.execute(
-        "UPDATE users SET daily_support_enabled = $1 WHERE user_id = $2",
-        enabled, user_id
-    )
\ No newline at end of file
+        """
+        WITH results AS (
+            SELECT * FROM unnest($1::bigint[], $2::varchar[]) AS r(user_id, status)
+        ), newly_blocked AS (
+            -- Блокировки, впервые замеченные этой рассылкой, — для ряда отписок в stats_daily
+            SELECT u.user_id FROM users u JOIN results r ON r.user_id = u.user_id
+            WHERE r.status = 'blocked' AND u.blocked_at IS NULL
+            FOR UPDATE OF u
+        ), updated AS (
+            UPDATE users AS u
+            SET blocked_at = CASE WHEN r.status = 'blocked' THEN COALESCE(u.blocked_at, CURRENT_TIMESTAMP) ELSE u.blocked_at END,
+                delivery_failures = CASE
+                    WHEN r.status = 'sent' THEN 0
+                    WHEN r.status IN ('blocked', 'unreachable') THEN u.delivery_failures + 1
+                    ELSE u.delivery_failures
+                END
+            FROM results r
+            -- 'failed' (сеть, сервер, ошибка в сообщении) не вина получателя: счетчик не меняется
+            WHERE u.user_id = r.user_id
+              AND (r.status IN ('blocked', 'unreachable') OR (r.status = 'sent' AND u.delivery_failures > 0))
+        )
+        INSERT INTO stats_daily AS s (day, slot, blocked)
+        SELECT CURRENT_DATE, user_id % $3, COUNT(*) FROM newly_blocked GROUP BY 2
+        ON CONFLICT (day, slot) DO UPDATE SET blocked = s.blocked + EXCLUDED.blocked
+        """,
+        [user_id for user_id, _ in results], [status for _, status in results], STATS_SLOTS
+    )
+
+@timed
+async def mark_user_blocked(conn, user_id):
+    """Отметить, что пользователь заблокировал бота"""
+    await conn.execute(
+        """
+        WITH blocked AS (
+            UPDATE users SET blocked_at = CURRENT_TIMESTAMP
+            WHERE user_id = $1 AND blocked_at IS NULL
+            RETURNING user_id
+        )
+        INSERT INTO stats_daily (day, slot, blocked)
+        SELECT CURRENT_DATE, $1 % $2, 1 FROM blocked
+        ON CONFLICT (day, slot) DO UPDATE SET blocked = stats_daily.blocked + 1
+        """,
+        user_id, STATS_SLOTS
+    )
+
+@timed
+async def reactivate_user(conn, user_id):
+    """Вернуть пользователя в рассылки (он снова пишет боту) и отметить его активным сегодня"""
+    await conn.execute(
+        """
+        WITH old AS (
+            SELECT user_id, blocked_at IS NOT NULL AS was_blocked, last_active_on IS DISTINCT FROM CURRENT_DATE AS first_today
+            FROM users
+            WHERE user_id = $1
+              AND (blocked_at IS NOT NULL OR delivery_failures > 0 OR last_active_on IS DISTINCT FROM CURRENT_DATE)
+            FOR UPDATE
+        ), changed AS (
+            UPDATE users AS u SET blocked_at = NULL, delivery_failures = 0, last_active_on = CURRENT_DATE
+            FROM old
+            WHERE u.user_id = old.user_id
+            RETURNING old.was_blocked, old.first_today
+        )
+        INSERT INTO stats_daily AS s (day, slot, active_users, returned)
+        SELECT CURRENT_DATE, $1 % $2, first_today::int, was_blocked::int FROM changed
+        WHERE first_today OR was_blocked
+        ON CONFLICT (day, slot) DO UPDATE SET
+            active_users = s.active_users + EXCLUDED.active_users,
+            returned = s.returned + EXCLUDED.returned
+        """,
+        user_id, STATS_SLOTS
+    )
+
+@timed
+async def finish_broadcast_job(conn, job_id):
+    """Завершить задание, если все его части отправлены: сохранить итоговые счетчики и удалить построчные доставки.
+    Возвращает счетчики по статусам только одной реплике — той, что завершила задание; остальным None"""
+    async with conn.transaction():
+        row = await conn.fetchrow(
+            """
+            UPDATE broadcast_jobs AS j
+            SET status = 'done', finished_at = CURRENT_TIMESTAMP,
+                sent_count = c.sent, blocked_count = c.blocked, failed_count = c.failed
+            FROM (
+                SELECT COUNT(*) FILTER (WHERE status = 'sent') AS sent,
+                       COUNT(*) FILTER (WHERE status = 'blocked') AS blocked,
+                       COUNT(*) FILTER (WHERE status = 'failed') AS failed
+                FROM broadcast_deliveries
+                WHERE job_id = $1
+            ) AS c
+            WHERE j.id = $1 AND j.status = 'running'
+              AND NOT EXISTS (SELECT 1 FROM broadcast_shards WHERE job_id = $1 AND NOT done)
+            RETURNING j.sent_count, j.blocked_count, j.failed_count
+            """,
+            job_id
+        )
+        if row is None:
+            return None
+        await conn.execute("DELETE FROM broadcast_deliveries WHERE job_id = $1", job_id)
+        await conn.execute("DELETE FROM broadcast_shards WHERE job_id = $1", job_id)
+    return {'sent': row['sent_count'], 'blocked': row['blocked_count'], 'failed': row['failed_count']}
+
+@timed
+async def acquire_lease(conn, name, holder, lease_seconds):
+    """Взять или продлить аренду роли. True — роль принадлежит holder еще lease_seconds секунд"""
+    owner = await conn.fetchval(
+        """
+        INSERT INTO leases (name, holder, expires_at)
+        VALUES ($1, $2, CURRENT_TIMESTAMP + make_interval(secs => $3))
+        ON CONFLICT (name) DO UPDATE
+        SET holder = EXCLUDED.holder, expires_at = EXCLUDED.expires_at
+        WHERE leases.holder = EXCLUDED.holder OR leases.expires_at < CURRENT_TIMESTAMP
+        RETURNING holder
+        """,
+        name, holder, lease_seconds
+    )
+    return owner == holder
+
+@timed
+async def release_lease(conn, name, holder):
+    """Отдать роль сразу (при остановке реплики), не дожидаясь истечения аренды"""
+    await conn.execute("DELETE FROM leases WHERE name = $1 AND holder = $2", name, holder)
+
+@timed
+async def save_conversation_summary(conn, user_id, summary, summarized_until_id):
+    """Сохранить сжатое содержание диалога (более старое содержание не перезаписывает более новое)"""
+    await conn.execute(
+        """
+        INSERT INTO conversation_summaries (user_id, summary, summarized_until_id)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (user_id) DO UPDATE
+        SET summary = EXCLUDED.summary,
+            summarized_until_id = EXCLUDED.summarized_until_id,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE conversation_summaries.summarized_until_id < EXCLUDED.summarized_until_id
+        """,
+        user_id, summary, summarized_until_id
+    )
+
+@timed
+async def get_fsm_record(conn, key):
+    """Получить состояние и данные FSM по ключу (None, если записи нет)"""
+    row = await conn.fetchrow("SELECT state, data FROM fsm_states WHERE key = $1", key)
+    return (row['state'], json.loads(row['data'])) if row else None
+
+@timed
+async def save_fsm_records(conn, records):
+    """Сохранить пачку записей FSM одним запросом: records — список (key, state, data)"""
+    await conn.execute(
+        """
+        INSERT INTO fsm_states (key, state, data, updated_at)
+        SELECT key, state, data::jsonb, CURRENT_TIMESTAMP
+        FROM unnest($1::varchar[], $2::varchar[], $3::text[]) AS r(key, state, data)
+        ON CONFLICT (key) DO UPDATE
+        SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+        """,
+        [key for key, _, _ in records],
+        [state for _, state, _ in records],
+        [json.dumps(data, ensure_ascii=False) for _, _, data in records]
+    )
@@ -1,31 +1,44 @@
+import logging
+import time
+from contextlib import aclosing
+from datetime import time as dt_time
 from aiogram import Router, F, Bot
 from aiogram.filters import Command
-from aiogram.types import Message, ReplyKeyboardRemove, CallbackQuery
+from aiogram.types import Message, ReplyKeyboardRemove, CallbackQuery, ChatMemberUpdated
 from aiogram.fsm.context import FSMContext
-from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 
-from config import TRIGGER_WORDS, ADMINS
+from config import ADMINS, STREAM_EDIT_INTERVAL, CONTEXT_FETCH_LIMIT
 from states import UserState, AdminState
 from keyboards import (
     get_period_keyboard, get_feedback_keyboard, get_cancel_keyboard,
     get_main_menu_keyboard, get_useful_materials_keyboard, get_more_materials_keyboard,
-    get_support_subscription_keyboard
+    get_support_subscription_keyboard, get_timezone_keyboard, get_delivery_time_keyboard, DELIVERY_TIMEZONES
 )
 from database import (
-    save_user, update_user_period, get_stats, get_period_stats, increment_question_count,
-    get_user_data, get_all_user_ids, save_message_to_history, get_message_history,
-    get_users_with_daily_support, toggle_daily_support, is_daily_support_enabled
+    get_stats, get_period_stats, get_daily_stats, get_all_user_ids, save_dialog_turn, mark_user_blocked, reactivate_user
 )
-from utils import ask_deepseek
-from daily_support import get_today_message
+from user_cache import (
+    get_user, save_user, update_user_period, toggle_daily_support, set_daily_delivery_time, start_question
+)
+from utils import DeepSeekClient, spawn
+from triggers import find_trigger
+from context import fit_history, refresh_summary
+from metrics import db_acquire_seconds, db_query_seconds
+from broadcast import create_job, run_job, payload_from_message
+from middlewares import forget_active_users
+from daily_support import catalog
+from notifications import notifier
+from question_guard import question_guard
+
+logger = logging.getLogger(__name__)
 
 router = Router()
 
 @router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext, pool):
     # Проверяем, зарегистрирован ли пользователь
-    async with pool.acquire() as conn:
-        user = await get_user_data(conn, message.from_user.id)
+    user = await get_user(pool, message.from_user.id)
     
     if user:
         # Пользователь уже зарегистрирован - просто показываем меню
@@ -125,14 +138,20 @@ async def cmd_stats(message: Message, pool):
     if message.from_user.id not in ADMINS:
         return
 
+    # Только готовые счетчики (stats_period, stats_daily): время ответа не зависит от числа пользователей
     async with pool.acquire() as conn:
-        user_count, question_count = await get_stats(conn)  # Теперь получаем два значения
+        user_count, question_count, subscriber_count = await get_stats(conn)
         period_stats = await get_period_stats(conn)
+        daily_stats = await get_daily_stats(conn)
 
+    today = daily_stats[-1]
     stats_text = [
         f"📊 Статистика бота:",
         f"Всего пользователей: {user_count}",
         f"Задано вопросов: {question_count}",
+        f"Подписаны на поддержку: {subscriber_count}",
+        "",
+        f"Сегодня: активных {today['active_users']}, новых {today['new_users']}, вопросов {today['questions']}",
         "",
         "📈 Распределение по периодам:"
     ]
@@ -140,21 +159,53 @@ async def cmd_stats(message: Message, pool):
     for stat in period_stats:
         stats_text.append(f"• {stat['period']}: {stat['user_count']} пользователей, {stat['total_questions']} вопросов")
 
+    stats_text += [
+        "",
+        "📅 По дням (активные / новые / вопросы / подписки +− / блокировки / вернулись):"
+    ]
+    for day in daily_stats:
+        stats_text.append(
+            f"• {day['day']:%d.%m}: {day['active_users']} / {day['new_users']} / {day['questions']} / "
+            f"+{day['subscribed']} −{day['unsubscribed']} / {day['blocked']} / {day['returned']}"
+        )
+
     await message.answer("\n".join(stats_text))
     
+@router.message(Command("dbstats"))
+async def cmd_dbstats(message: Message, pool):
+    """Статистика пула PostgreSQL для подбора его размера"""
+    if message.from_user.id not in ADMINS:
+        return
+    
+    def ms(seconds):
+        return "—" if seconds is None else f"≤{seconds * 1000:g} мс"
+    
+    stats_text = [
+        "🗄 Пул PostgreSQL:",
+        f"Соединений: {pool.get_size()} (свободно {pool.get_idle_size()}, максимум {pool.get_max_size()})",
+        f"Ожидание соединения: p50 {ms(db_acquire_seconds.quantile(0.5))}, "
+        f"p95 {ms(db_acquire_seconds.quantile(0.95))}, p99 {ms(db_acquire_seconds.quantile(0.99))}",
+        "",
+        "⏱ Запросы (p95, количество):"
+    ]
+    for labels, _, _, count in sorted(db_query_seconds.series(), key=lambda s: -s[3]):
+        stats_text.append(f"• {labels['query']}: {ms(db_query_seconds.quantile(0.95, **labels))}, {count}")
+    
+    await message.answer("\n".join(stats_text))
+
 @router.message(Command("send"))
 async def cmd_send(message: Message, state: FSMContext):
     """Команда для админов для рассылки сообщений всем пользователям"""
-    #print(f"DEBUG: Команда /send получена от пользователя {message.from_user.id}, ADMINS={ADMINS}", flush=True)
+    logger.debug("Команда /send получена от пользователя %s, ADMINS=%s", message.from_user.id, ADMINS)
     
     if message.from_user.id not in ADMINS:
-        #print(f"DEBUG: Пользователь {message.from_user.id} не является админом", flush=True)
+        logger.debug("Пользователь %s не является админом", message.from_user.id)
         return
     
-    #print(f"DEBUG: Устанавливаем состояние AdminState.waiting_broadcast", flush=True)
+    logger.debug("Устанавливаем состояние AdminState.waiting_broadcast")
     await state.set_state(AdminState.waiting_broadcast)
     current_state = await state.get_state()
-    #print(f"DEBUG: Текущее состояние после установки: {current_state}", flush=True)
+    logger.debug("Текущее состояние после установки: %s", current_state)
     
     await message.answer(
         "📢 Режим рассылки\n\n"
@@ -174,20 +225,15 @@ async def cancel_broadcast(callback: CallbackQuery, state: FSMContext):
 @router.message(AdminState.waiting_broadcast)
 async def process_broadcast(message: Message, state: FSMContext, bot: Bot, pool):
     """Обработка сообщения для рассылки"""
-    import sys
-    #print(f"DEBUG: process_broadcast вызван, user_id={message.from_user.id}, ADMINS={ADMINS}", flush=True)
-    sys.stdout.flush()
+    logger.debug("process_broadcast вызван, user_id=%s, ADMINS=%s", message.from_user.id, ADMINS)
     
     if message.from_user.id not in ADMINS:
-        #print(f"DEBUG: Пользователь {message.from_user.id} не является админом")
+        logger.debug("Пользователь %s не является админом", message.from_user.id)
         return
     
-    #print(f"DEBUG: Начинаем рассылку, тип сообщения: {type(message)}", flush=True)
-    
     # Получаем список всех пользователей
     async with pool.acquire() as conn:
         user_ids = await get_all_user_ids(conn)
-        #print(f"DEBUG: Получены user_ids из БД: {user_ids}", flush=True)
     
     total_users = len(user_ids)
     if total_users == 0:
@@ -195,127 +241,20 @@ async def process_broadcast(message: Message, state: FSMContext, bot: Bot, pool)
         await state.clear()
         return
     
-    # Логируем для отладки
-    #print(f"Рассылка: найдено {total_users} пользователей: {user_ids}", flush=True)
-    
     # Отправляем сообщение о начале рассылки
     status_msg = await message.answer(f"📤 Начинаю рассылку для {total_users} пользователей...")
     
-    success_count = 0
-    failed_count = 0
-    
-    # Рассылаем сообщение всем пользователям
-    for user_id in user_ids:
-        try:
-            #print(f"Попытка отправить сообщение пользователю {user_id}...", flush=True)
-            # Определяем тип сообщения и отправляем соответственно
-            if message.photo:
-                # Фото с подписью или без
-                await bot.send_photo(
-                    chat_id=user_id,
-                    photo=message.photo[-1].file_id,
-                    caption=message.caption,
-                    caption_entities=message.caption_entities
-                )
-            elif message.video:
-                # Видео
-                await bot.send_video(
-                    chat_id=user_id,
-                    video=message.video.file_id,
-                    caption=message.caption,
-                    caption_entities=message.caption_entities
-                )
-            elif message.audio:
-                # Аудио
-                await bot.send_audio(
-                    chat_id=user_id,
-                    audio=message.audio.file_id,
-                    caption=message.caption,
-                    caption_entities=message.caption_entities
-                )
-            elif message.voice:
-                # Голосовое сообщение
-                await bot.send_voice(
-                    chat_id=user_id,
-                    voice=message.voice.file_id,
-                    caption=message.caption,
-                    caption_entities=message.caption_entities
-                )
-            elif message.video_note:
-                # Кружочек (видео-заметка)
-                await bot.send_video_note(
-                    chat_id=user_id,
-                    video_note=message.video_note.file_id
-                )
-            elif message.document:
-                # Документ
-                await bot.send_document(
-                    chat_id=user_id,
-                    document=message.document.file_id,
-                    caption=message.caption,
-                    caption_entities=message.caption_entities
-                )
-            elif message.sticker:
-                # Стикер
-                await bot.send_sticker(
-                    chat_id=user_id,
-                    sticker=message.sticker.file_id
-                )
-            elif message.animation:
-                # GIF
-                await bot.send_animation(
-                    chat_id=user_id,
-                    animation=message.animation.file_id,
-                    caption=message.caption,
-                    caption_entities=message.caption_entities
-                )
-            elif message.text:
-                # Текстовое сообщение
-                #print(f"DEBUG: Отправляем текстовое сообщение пользователю {user_id}: {message.text[:50]}...", flush=True)
-                # Используем entities если они есть, но не parse_mode (он может отсутствовать)
-                send_kwargs = {"chat_id": user_id, "text": message.text}
-                if message.entities:
-                    send_kwargs["entities"] = message.entities
-                await bot.send_message(**send_kwargs)
-            else:
-                # Для других типов используем copy_message
-                #print(f"DEBUG: Используем copy_message для пользователя {user_id}", flush=True)
-                await bot.copy_message(
-                    chat_id=user_id,
-                    from_chat_id=message.chat.id,
-                    message_id=message.message_id
-                )
-            success_count += 1
-            #print(f"✅ Сообщение успешно отправлено пользователю {user_id}", flush=True)
-        except Exception as e:
-            failed_count += 1
-            error_msg = str(e)
-            #print(f"Ошибка при отправке пользователю {user_id}: {error_msg}", flush=True)
-            # Логируем детали ошибки для отладки
-            if "chat not found" in error_msg.lower() or "blocked" in error_msg.lower():
-                #print(f"  -> Пользователь {user_id} заблокировал бота или чат не найден", flush=True)
-                pass
-            elif "forbidden" in error_msg.lower():
-                #print(f"  -> Бот заблокирован пользователем {user_id}", flush=True)
-                pass
-            else:
-                #print(f"  -> Другая ошибка: {error_msg}", flush=True)
-                pass
-    
-    # Обновляем статус
-    await status_msg.edit_text(
-        f"✅ Рассылка завершена!\n\n"
-        f"✅ Успешно: {success_count}\n"
-        f"❌ Ошибок: {failed_count}\n"
-        f"📊 Всего: {total_users}"
-    )
+    # Задание сохраняется в БД до начала отправки, поэтому после рестарта рассылка продолжится с того же места
+    job_id = await create_job(pool, 'manual', payload_from_message(message), user_ids, status_message=status_msg)
+    # Рассылка идет в фоне: обработчик админа не ждет последнего пользователя
+    spawn(run_job(bot, pool, job_id))
     
     await state.clear()
     
     
 # Обработка главного меню
 @router.message(UserState.main)
-async def process_main_menu(message: Message, state: FSMContext, pool, bot: Bot):
+async def process_main_menu(message: Message, state: FSMContext, pool, bot: Bot, llm: DeepSeekClient):
     user_text = message.text
     
     if user_text == "Посмотреть полезные материалы":
@@ -330,19 +269,19 @@ async def process_main_menu(message: Message, state: FSMContext, pool, bot: Bot)
             reply_markup=ReplyKeyboardRemove()
         )
     elif user_text == "Получить порцию поддержки":
-        # Получаем сегодняшнее сообщение поддержки
-        support_message = get_today_message()
+        # Профиль из кэша: период для выбора темы и подписка на ежедневную поддержку
+        user = await get_user(pool, message.from_user.id)
+        is_subscribed = bool(user and user['daily_support_enabled'])
         
-        # Проверяем, подписан ли пользователь на ежедневную поддержку
-        async with pool.acquire() as conn:
-            is_subscribed = await is_daily_support_enabled(conn, message.from_user.id)
+        # Сообщение по теме периода из каталога в памяти, без повторов; ежедневная ротация не сдвигается
+        support_message = catalog.on_demand(message.from_user.id, user['period'] if user else None)
         
         # Отправляем сообщение поддержки
         await message.answer(support_message)
         
         # Отправляем сообщение с подписью и кнопкой подписки
         if is_subscribed:
-            caption = "Вы подписаны на ежедневную поддержку. Каждое утро в 9:00 вы будете получать сообщение поддержки от Милы."
+            caption = f"Вы подписаны на ежедневную поддержку. Каждый день около {format_delivery_time(user)} вы будете получать сообщение поддержки от Милы."
         else:
             caption = "Если не подписаны, подпишитесь и получайте поддержку от Милы каждое утро."
         
@@ -353,25 +292,62 @@ async def process_main_menu(message: Message, state: FSMContext, pool, bot: Bot)
     else:
         # Если это не команда меню, возможно пользователь хочет задать вопрос
         await state.set_state(UserState.waiting_question)
-        await process_question(message, state, pool, bot)
+        await process_question(message, state, pool, bot, llm)
 
 # Обработка вопросов с контекстом
 @router.message(UserState.waiting_question)
-async def process_question_handler(message: Message, state: FSMContext, pool, bot: Bot):
+async def process_question_handler(message: Message, state: FSMContext, pool, bot: Bot, llm: DeepSeekClient):
     user_text = message.text
     
     # Если пользователь нажал кнопку меню, обрабатываем как меню
     if user_text in ["Посмотреть полезные материалы", "Задать вопрос", "Получить порцию поддержки"]:
         await state.set_state(UserState.main)
-        await process_main_menu(message, state, pool, bot)
+        await process_main_menu(message, state, pool, bot, llm)
         return
     
     # Иначе обрабатываем как вопрос
-    await process_question(message, state, pool, bot)
+    await process_question(message, state, pool, bot, llm)
+
+async def stream_answer(message: Message, chunks, show_feedback: bool) -> str:
+    """Показать ответ LLM по мере генерации: сообщение отправляется с первыми токенами и дописывается правками"""
+    answer = ""
+    answer_msg = None
+    last_edit = 0.0
+    
+    async for chunk in chunks:
+        answer += chunk
+        if not answer.strip():
+            continue
+        if answer_msg is None:
+            # Reply-клавиатуру меню можно прикрепить только при отправке, inline-кнопки обратной связи — финальной правкой
+            answer_msg = await message.answer(
+                answer,
+                reply_markup=None if show_feedback else get_main_menu_keyboard()
+            )
+            last_edit = time.monotonic()
+        elif time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            await edit_answer(answer_msg, answer)
+            last_edit = time.monotonic()
+    
+    final_text = answer + "\n\n⚠️ Важно! Я не заменяю врача. При серьезных симптомах обращайся к специалисту."
+    if answer_msg is None:
+        await message.answer(
+            final_text,
+            reply_markup=get_feedback_keyboard() if show_feedback else get_main_menu_keyboard()
+        )
+    else:
+        await edit_answer(answer_msg, final_text, get_feedback_keyboard() if show_feedback else None)
+    return answer
+
+async def edit_answer(answer_msg: Message, text: str, reply_markup=None):
+    try:
+        await answer_msg.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest:
+        # Например, "message is not modified" — ответ уже показан
+        pass
 
 # Функция обработки вопроса (используется из разных мест)
-async def process_question(message: Message, state: FSMContext, pool, bot: Bot):
-    user_data = await state.get_data()
+async def process_question(message: Message, state: FSMContext, pool, bot: Bot, llm: DeepSeekClient):
     user_text = message.text
     
     # Проверяем, что это текстовое сообщение
@@ -383,7 +359,8 @@ async def process_question(message: Message, state: FSMContext, pool, bot: Bot):
         await state.set_state(UserState.main)
         return
     
-    if any(trigger in user_text.lower() for trigger in TRIGGER_WORDS):
+    # Тревожные слова проверяются один раз на сообщение (одно скомпилированное выражение)
+    if find_trigger(user_text):
         await message.answer(
             "🚨 ВНИМАНИЕ! При таких симптомах необходимо НЕМЕДЛЕННО обратиться к врачу или вызвать скорую помощь.\n\n"
             "Это не вопрос для чат-бота. Пожалуйста, не теряйте время - обратитесь за медицинской помощи прямо сейчас!",
@@ -392,77 +369,86 @@ async def process_question(message: Message, state: FSMContext, pool, bot: Bot):
         await state.set_state(UserState.main)
         return
     
-    # Получаем историю сообщений для контекста
+    # Очередь к DeepSeek переполнена: быстро отвечаем, не тратя запрос
+    if llm.overloaded:
+        await message.answer("Сейчас очень много вопросов 🙏 Попробуй, пожалуйста, через пару минут.")
+        return
+    
+    # Один запрос к LLM на пользователя: сообщения, пришедшие подряд, склеиваются в один вопрос
+    leader = question_guard.add(message.from_user.id, user_text)
+    if leader is None:
+        await message.answer("Я еще отвечаю на предыдущие сообщения, подожди немного 🙏")
+        return
+    if not leader:
+        # Сообщение войдет в вопрос, который уже обрабатывается
+        return
+    # aclosing: при ошибке ответа очередь пользователя освобождается сразу, а не когда сборщик закроет генератор
+    async with aclosing(question_guard.rounds(message.from_user.id)) as rounds:
+        async for question in rounds:
+            await answer_question(message, state, pool, llm, question)
+
+async def answer_question(message: Message, state: FSMContext, pool, llm: DeepSeekClient, user_text: str):
+    """Ответить на (склеенный) вопрос пользователя с учетом контекста"""
+    user_data = await state.get_data()
+    
+    if llm.busy:
+        await message.answer("⏳ Сейчас много вопросов, ответ займет чуть больше времени.")
+    
+    # Увеличиваем счетчик вопросов и получаем историю сообщений для контекста одним запросом
     async with pool.acquire() as conn:
-        message_history = await get_message_history(conn, message.from_user.id, limit=10)
-        await increment_question_count(conn, message.from_user.id)
-        user_question_count = await conn.fetchval(
-            "SELECT question_count FROM users WHERE user_id = $1",
-            message.from_user.id
+        user_question_count, summary, message_history = await start_question(
+            conn, message.from_user.id, history_limit=CONTEXT_FETCH_LIMIT
         )
     
-    # Отправляем вопрос в LLM с контекстом
-    gpt_response = await ask_deepseek(
-        user_text,
-        user_data.get('name', ''),
-        user_data.get('period', ''),
-        message_history=message_history
+    # В промпт идут только свежие реплики в пределах бюджета токенов, более старые сворачиваются в фоне
+    message_history, overflow = fit_history(message_history, summary)
+    if overflow:
+        spawn(refresh_summary(pool, llm, message.from_user.id, summary, overflow))
+    
+    # Показываем кнопку обратной связи после 1, 3 и 30 ответов
+    show_feedback = user_question_count in [1, 3, 30]
+    
+    # Отправляем вопрос в LLM с контекстом, ответ показываем по мере генерации
+    gpt_response = await stream_answer(
+        message,
+        llm.stream(
+            user_text,
+            user_data.get('name', ''),
+            user_data.get('period', ''),
+            message_history=message_history,
+            summary=summary
+        ),
+        show_feedback
     )
     
-    if gpt_response is None:
-        await message.answer(
-            "🚨 ВНИМАНИЕ! При таких симптомах необходимо НЕМЕДЛЕННО обратиться к врачу или вызвать скорую помощь.\n\n"
-            "Это не вопрос для чат-бота. Пожалуйста, не теряйте время - обратитесь за медицинской помощи прямо сейчас!",
-            reply_markup=get_main_menu_keyboard(),
-            parse_mode=ParseMode.MARKDOWN
-        )
-        await state.set_state(UserState.main)
-    else:
-        # Сохраняем сообщения в историю
-        async with pool.acquire() as conn:
-            await save_message_to_history(conn, message.from_user.id, "user", user_text)
-            await save_message_to_history(conn, message.from_user.id, "assistant", gpt_response)
-        
-        await state.update_data(
-            last_question=user_text,
-            last_answer=gpt_response
-        )
-        
-        # Показываем кнопку обратной связи после 1, 3 и 30 ответов
-        show_feedback = user_question_count in [1, 3, 30]
-        
-        # Используем клавиатуру меню, чтобы пользователь мог вернуться или продолжить диалог
-        reply_markup = get_feedback_keyboard() if show_feedback else get_main_menu_keyboard()
-        await message.answer(
-            gpt_response + "\n\n⚠️ Важно! Я не заменяю врача. При серьезных симптомах обращайся к специалисту.",
-            reply_markup=reply_markup
-        )
-        
-        # Остаемся в состоянии ожидания вопроса для продолжения диалога
-        # Пользователь может задать следующий вопрос (будет обработан как вопрос)
-        # или нажать кнопку меню (будет обработан как команда меню)
-        
-        # Отправляем уведомление админам (с обработкой ошибок)
-        for admin_id in ADMINS:
-            try:
-                await bot.send_message(
-                    admin_id,
-                    f"Пользователь ({user_data.get('period')}) {message.from_user.full_name} (@{message.from_user.username}) спросил:\n"
-                    f"{user_text}\n\n"
-                    f"Ответ: {gpt_response}\n"
-                    f"Всего вопросов от пользователя: {user_question_count}"
-                )
-            except Exception as e:
-                #print(f"Ошибка при отправке сообщения админу {admin_id}: {e}")
-                pass
+    # Сохраняем сообщения в историю
+    async with pool.acquire() as conn:
+        await save_dialog_turn(conn, message.from_user.id, user_text, gpt_response)
+    
+    await state.update_data(
+        last_question=user_text,
+        last_answer=gpt_response
+    )
+    
+    # Остаемся в состоянии ожидания вопроса для продолжения диалога
+    # Пользователь может задать следующий вопрос (будет обработан как вопрос)
+    # или нажать кнопку меню (будет обработан как команда меню)
+    
+    # Уведомление админам уходит в фоне дайджестом и не задерживает ответ пользователю
+    notifier.notify(
+        'question',
+        f"Пользователь ({user_data.get('period')}) {message.from_user.full_name} (@{message.from_user.username}) спросил:\n"
+        f"{user_text}\n\n"
+        f"Ответ: {gpt_response}\n"
+        f"Всего вопросов от пользователя: {user_question_count}"
+    )
 
 
 @router.callback_query(F.data == "menu")
 async def menu_callback(callback: CallbackQuery, state: FSMContext, pool):
     """Обработка нажатия на кнопку 'Меню' - аналогично команде /start"""
     # Проверяем, зарегистрирован ли пользователь
-    async with pool.acquire() as conn:
-        user = await get_user_data(conn, callback.from_user.id)
+    user = await get_user(pool, callback.from_user.id)
     
     if user:
         # Пользователь уже зарегистрирован - просто показываем меню
@@ -498,19 +484,14 @@ async def process_feedback(message: Message, state: FSMContext, bot: Bot):
     feedback_text = message.text
     data = await state.get_data()
     
-    # Отправляем админам обратную связь (с обработкой ошибок)
-    for admin_id in ADMINS:
-        try:
-            await bot.send_message(
-                admin_id,
-                f"Обратная связь от пользователя ({data.get('period')}) {message.from_user.full_name} (@{message.from_user.username}):\n\n"
-                f"Вопрос: {data['last_question']}\n\n"
-                f"Ответ: {data['last_answer']}\n\n"
-                f"Обратная связь: {feedback_text}"
-            )
-        except Exception as e:
-            #print(f"Ошибка при отправке обратной связи админу {admin_id}: {e}")
-            pass
+    # Обратная связь попадает в дайджест для админов
+    notifier.notify(
+        'feedback',
+        f"Обратная связь от пользователя ({data.get('period')}) {message.from_user.full_name} (@{message.from_user.username}):\n\n"
+        f"Вопрос: {data['last_question']}\n\n"
+        f"Ответ: {data['last_answer']}\n\n"
+        f"Обратная связь: {feedback_text}"
+    )
     
     await state.set_state(UserState.main)
     await message.answer("Спасибо за вашу обратную связь! 💕")
@@ -524,10 +505,11 @@ async def handle_support_subscription(callback: CallbackQuery, pool):
     
     async with pool.acquire() as conn:
         await toggle_daily_support(conn, user_id, is_subscribe)
-        is_subscribed = await is_daily_support_enabled(conn, user_id)
+    user = await get_user(pool, user_id)
+    is_subscribed = bool(user and user['daily_support_enabled'])
     
     if is_subscribe:
-        message_text = "✅ Вы подписаны на ежедневную поддержку! Каждое утро в 9:00 вы будете получать сообщение поддержки от Милы."
+        message_text = f"✅ Вы подписаны на ежедневную поддержку! Каждый день около {format_delivery_time(user)} вы будете получать сообщение поддержки от Милы."
     else:
         message_text = "❌ Вы отписаны от ежедневной поддержки."
     
@@ -537,6 +519,42 @@ async def handle_support_subscription(callback: CallbackQuery, pool):
     )
     await callback.answer()
     
+def format_delivery_time(user):
+    """Время ежедневной поддержки пользователя для подписи, например «09:00 (Москва (МСК))»"""
+    zone = next((label for label, name in DELIVERY_TIMEZONES if name == user['timezone']), user['timezone'])
+    return f"{user['delivery_time']:%H:%M} ({zone})"
+
+# Настройка времени ежедневной поддержки: часовой пояс, затем время
+@router.callback_query(F.data == "delivery_settings")
+async def handle_delivery_settings(callback: CallbackQuery):
+    await callback.message.edit_text("Выберите ваш часовой пояс:", reply_markup=get_timezone_keyboard())
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("delivery_tz:"))
+async def handle_delivery_timezone(callback: CallbackQuery):
+    tz_index = int(callback.data.split(":")[1])
+    await callback.message.edit_text(
+        "Во сколько присылать поддержку?",
+        reply_markup=get_delivery_time_keyboard(tz_index)
+    )
+    await callback.answer()
+
+@router.callback_query(F.data.startswith("delivery_time:"))
+async def handle_delivery_time(callback: CallbackQuery, pool):
+    _, tz_index, value = callback.data.split(":", 2)
+    timezone = DELIVERY_TIMEZONES[int(tz_index)][1]
+    hours, minutes = map(int, value.split(":"))
+    
+    async with pool.acquire() as conn:
+        await set_daily_delivery_time(conn, callback.from_user.id, timezone, dt_time(hours, minutes))
+    user = await get_user(pool, callback.from_user.id)
+    
+    await callback.message.edit_text(
+        f"✅ Готово! Сообщение поддержки будет приходить каждый день около {format_delivery_time(user)}.",
+        reply_markup=get_support_subscription_keyboard(bool(user and user['daily_support_enabled']))
+    )
+    await callback.answer()
+    
 # Обработка callback для полезных материалов
 @router.callback_query(F.data.startswith("material_"))
 async def handle_material_callback(callback: CallbackQuery):
@@ -564,17 +582,27 @@ async def handle_material_callback(callback: CallbackQuery):
     
     await callback.answer()
 
+# Пользователь заблокировал или разблокировал бота
+@router.my_chat_member()
+async def handle_bot_status_change(event: ChatMemberUpdated, pool):
+    status = event.new_chat_member.status
+    async with pool.acquire() as conn:
+        if status == "kicked":
+            await mark_user_blocked(conn, event.from_user.id)
+            forget_active_users([event.from_user.id])
+        elif status == "member":
+            await reactivate_user(conn, event.from_user.id)
+
 @router.message()
-async def handle_unregistered_user(message: Message, state: FSMContext, pool, bot: Bot):
+async def handle_unregistered_user(message: Message, state: FSMContext, pool, bot: Bot, llm: DeepSeekClient):
     # Пропускаем сообщения в состоянии рассылки - они обрабатываются отдельным обработчиком
     current_state = await state.get_state()
     if current_state == AdminState.waiting_broadcast:
-        #print(f"DEBUG: Общий обработчик пропускает сообщение - состояние AdminState.waiting_broadcast", flush=True)
+        logger.debug("Общий обработчик пропускает сообщение - состояние AdminState.waiting_broadcast")
         return
     
     # Проверяем, зарегистрирован ли пользователь в базе
-    async with pool.acquire() as conn:
-        user = await get_user_data(conn, message.from_user.id)
+    user = await get_user(pool, message.from_user.id)
     
     if user:
         # Если пользователь найден в базе, восстанавливаем его состояние
@@ -589,14 +617,14 @@ async def handle_unregistered_user(message: Message, state: FSMContext, pool, bo
         
         # Если пользователь в главном меню, обрабатываем как меню
         if await state.get_state() == UserState.main:
-            await process_main_menu(message, state, pool, bot)
+            await process_main_menu(message, state, pool, bot, llm)
         # Если пользователь в режиме вопроса, обрабатываем как вопрос
         elif await state.get_state() == UserState.waiting_question:
-            await process_question(message, state, pool, bot)
+            await process_question(message, state, pool, bot, llm)
         else:
             # По умолчанию - главное меню
             await state.set_state(UserState.main)
-            await process_main_menu(message, state, pool, bot)
+            await process_main_menu(message, state, pool, bot, llm)
     else:
         # Если пользователь не найден, предлагаем начать с /start
         await message.answer(
@@ -66,8 +66,39 @@ def get_support_subscription_keyboard(is_subscribed: bool):
         button_text = "Подписаться на ежедневную поддержку"
         callback_data = "subscribe_support"
     
+    buttons = [[InlineKeyboardButton(text=button_text, callback_data=callback_data)]]
+    if is_subscribed:
+        buttons.append([InlineKeyboardButton(text="🕘 Изменить время", callback_data="delivery_settings")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+# Часовые пояса для ежедневной поддержки: (подпись, имя пояса IANA)
+DELIVERY_TIMEZONES = [
+    ("Калининград (МСК−1)", "Europe/Kaliningrad"),
+    ("Москва (МСК)", "Europe/Moscow"),
+    ("Самара (МСК+1)", "Europe/Samara"),
+    ("Екатеринбург (МСК+2)", "Asia/Yekaterinburg"),
+    ("Омск (МСК+3)", "Asia/Omsk"),
+    ("Новосибирск (МСК+4)", "Asia/Novosibirsk"),
+    ("Иркутск (МСК+5)", "Asia/Irkutsk"),
+    ("Якутск (МСК+6)", "Asia/Yakutsk"),
+    ("Владивосток (МСК+7)", "Asia/Vladivostok"),
+]
+
+DELIVERY_TIMES = ["07:00", "08:00", "09:00", "10:00", "12:00", "18:00", "20:00", "21:00"]
+
+def get_timezone_keyboard():
+    """Выбор часового пояса; в callback_data — индекс пояса в DELIVERY_TIMEZONES"""
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text=button_text, callback_data=callback_data)]
+            [InlineKeyboardButton(text=label, callback_data=f"delivery_tz:{index}")]
+            for index, (label, _) in enumerate(DELIVERY_TIMEZONES)
         ]
-    )
\ No newline at end of file
+    )
+
+def get_delivery_time_keyboard(tz_index: int):
+    """Выбор времени ежедневной поддержки (по 4 кнопки в ряд)"""
+    buttons = [
+        InlineKeyboardButton(text=value, callback_data=f"delivery_time:{tz_index}:{value}")
+        for value in DELIVERY_TIMES
+    ]
+    return InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 4] for i in range(0, len(buttons), 4)])
\ No newline at end of file
@@ -0,0 +1,130 @@
+import contextvars
+import json
+import logging
+import queue
+import random
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from config import LOG_LEVEL, LOG_LEVELS, LOG_SAMPLING, LOG_QUEUE_SIZE
+from metrics import Counter
+
+# Поля текущего контекста (update_id, user_id, job_id...), попадают в каждую запись.
+# contextvars копируются в задачи asyncio, поэтому у каждого обновления свой контекст
+_context = contextvars.ContextVar('log_context', default={})
+
+# Стандартные атрибуты LogRecord: всё остальное пришло через extra= и пишется отдельными полями
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'context'}
+
+log_records_dropped = Counter('log_records_dropped_total', 'Записи лога, отброшенные при переполнении очереди')
+
+
+def _parse_pairs(text):
+    """"a=1,b=2" -> {'a': '1', 'b': '2'}"""
+    pairs = {}
+    for item in text.split(','):
+        if '=' in item:
+            name, value = item.split('=', 1)
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+@contextmanager
+def log_context(**fields):
+    """Добавить поля ко всем записям внутри блока (и в запущенных из него задачах)"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.message,
+        }
+        entry.update(getattr(record, 'context', {}))
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRS:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Оставляет долю rate записей ниже WARNING от модулей из rates (с учетом вложенных логгеров)"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return random.random() < rate
+            name = name.rpartition('.')[0]
+        return True
+
+
+class AsyncQueueHandler(QueueHandler):
+    """В потоке бота запись только дополняется контекстом и кладется в очередь.
+    Трассировка, JSON и запись в stdout выполняются потоком QueueListener"""
+
+    def prepare(self, record):
+        # Аргументы подставляются сразу: к моменту записи изменяемые объекты могут измениться
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        record.context = _context.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+_listener = None
+
+
+def setup_logging(level=LOG_LEVEL, levels=LOG_LEVELS, sampling=LOG_SAMPLING, queue_size=LOG_QUEUE_SIZE, stream=None):
+    """Настроить корневой логгер: очередь в памяти, отдельный поток пишет JSON в stdout"""
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+    records = queue.Queue(queue_size)
+    handler = AsyncQueueHandler(records)
+    handler.addFilter(SamplingFilter({name: float(rate) for name, rate in _parse_pairs(sampling).items()}))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+    for name, module_level in _parse_pairs(levels).items():
+        logging.getLogger(name).setLevel(module_level.upper())
+
+    _listener = QueueListener(records, output)
+    _listener.start()
+
+
+def shutdown_logging():
+    """Дописать оставшиеся записи и остановить поток логирования"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,27 +1,95 @@
 import asyncio
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 
-from config import BOT_TOKEN
+from config import BOT_TOKEN, BOT_MODE
 from database import create_db_pool, init_db
 from handlers import router
+from middlewares import ReactivationMiddleware, MetricsMiddleware, CorrelationMiddleware
 from scheduler import schedule_daily_messages
+from retention import schedule_retention
+from broadcast import broadcast_worker
+from coordination import Lease
+from utils import DeepSeekClient
+from answer_cache import AnswerCache
+from storage import PostgresStorage
+from webhook import run_webhook
+from daily_support import catalog
+from notifications import notifier
+from metrics import start_metrics_server
+from logs import setup_logging, shutdown_logging
 
 async def main():
+    # JSON-логи пишет отдельный поток: обработчики только кладут записи в очередь
+    setup_logging()
+    
     bot = Bot(token=BOT_TOKEN)
-    storage = MemoryStorage()
+    
+    pool = await create_db_pool()
+    await init_db()
+    
+    # Состояния FSM переживают рестарт и общие для всех реплик
+    storage = PostgresStorage(pool)
     dp = Dispatcher(storage=storage)
     
     dp.include_router(router)
     
-    pool = await create_db_pool()
-    await init_db(pool)
+    # update_id и user_id в каждой записи лога, сделанной при обработке обновления
+    dp.update.outer_middleware(CorrelationMiddleware())
+    
+    # Пользователь, написавший боту, снова получает рассылки
+    dp.message.outer_middleware(ReactivationMiddleware())
+    dp.callback_query.outer_middleware(ReactivationMiddleware())
+    
+    # Время работы хендлеров для /metrics
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
+    
+    # Метрики в формате Prometheus на локальном порту (METRICS_PORT)
+    metrics_runner = await start_metrics_server()
+    
+    # Каталог ежедневных сообщений читается один раз; дальше — только при изменении файла
+    catalog.refresh()
+    
+    # Один клиент DeepSeek на весь процесс: соединения переиспользуются между вопросами
+    llm = await DeepSeekClient(cache=AnswerCache()).start()
+    
+    # Рассылки делятся на части между репликами; брошенные (после рестарта или падения) части подбираются здесь же
+    asyncio.create_task(broadcast_worker(bot, pool))
+    
+    # Планировщик и обслуживание истории выполняет только одна реплика — текущий лидер
+    leader = Lease(pool, 'scheduler')
+    asyncio.create_task(leader.keep())
     
     # Запускаем планировщик ежедневных сообщений в фоне
-    asyncio.create_task(schedule_daily_messages(bot, pool))
+    asyncio.create_task(schedule_daily_messages(bot, pool, leader))
+    
+    # Обслуживание истории сообщений: новые партиции, архив старых, лимит на пользователя
+    asyncio.create_task(schedule_retention(leader))
+    
+    # Дайджесты уведомлений админам
+    asyncio.create_task(notifier.run(bot))
     
     # Запускаем бота с дополнительными параметрами
-    await dp.start_polling(bot, pool=pool, allowed_updates=dp.resolve_used_update_types())
+    try:
+        if BOT_MODE == 'webhook':
+            # Обновления приходят HTTP-запросами: несколько реплик можно поставить за балансировщик
+            await run_webhook(dp, bot, pool=pool, llm=llm)
+        else:
+            # getUpdates не работает, пока установлен вебхук от прошлого запуска в режиме webhook
+            await bot.delete_webhook()
+            await dp.start_polling(bot, pool=pool, llm=llm, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await llm.close()
+        # Отдаем роль лидера сразу, а не через LEADER_LEASE_TTL
+        await leader.release()
+        # Dispatcher не закрывает хранилище сам: сбрасываем отложенные записи
+        await storage.close()
+        # Последний дайджест; сессию бота polling/webhook уже закрыли, поэтому закрываем её еще раз после отправки
+        await notifier.flush(bot)
+        await bot.session.close()
+        shutdown_logging()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,203 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT
+
+# Границы корзин по умолчанию, в секундах: от 1 мс до 30 с
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Все метрики процесса в порядке создания — их отдает /metrics
+REGISTRY = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Метрика с наборами меток. На горячем пути — только изменение числа в словаре;
+    значения, которые и так считаются в других объектах (кэши, пул), читаются функциями track при экспорте"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        # labels -> значение
+        self._values = {}
+        # labels -> функция, возвращающая текущее значение
+        self._tracked = {}
+        REGISTRY.append(self)
+
+    def track(self, func, **labels):
+        """Брать значение для этих меток из func() в момент экспорта"""
+        self._tracked[tuple(sorted(labels.items()))] = func
+
+    def value(self, **labels):
+        key = tuple(sorted(labels.items()))
+        func = self._tracked.get(key)
+        return func() if func else self._values.get(key, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        for key, func in self._tracked.items():
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Текущее значение (размер очереди, число соединений)"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (кумулятивные счетчики считаются при чтении)"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по корзинам + корзина +Inf, сумма, количество]
+        self._series = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def series(self):
+        """Пары (labels, counts, sum, count) для всех наборов меток"""
+        for key, (counts, total, count) in self._series.items():
+            yield dict(key), counts, total, count
+
+    def quantile(self, q, **labels):
+        """Оценка квантиля по корзинам (верхняя граница корзины); None, если наблюдений нет"""
+        series = self._series.get(tuple(sorted(labels.items())))
+        if not series or not series[2]:
+            return None
+        rank = q * series[2]
+        seen = 0
+        for index, bucket_count in enumerate(series[0]):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(key + (('le', _format_value(float(bound))),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+def exposition():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=exposition(), content_type='text/plain', charset='utf-8', headers={'Cache-Control': 'no-cache'})
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Запустить HTTP-сервер с /metrics; None, если порт не задан. Возвращает AppRunner для остановки"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+db_acquire_seconds = Histogram('db_pool_acquire_seconds', 'Ожидание соединения из пула PostgreSQL')
+db_query_seconds = Histogram('db_query_seconds', 'Время выполнения запросов к PostgreSQL')
+db_pool_connections = Gauge('db_pool_connections', 'Соединения пула PostgreSQL')
+
+handler_seconds = Histogram('bot_handler_seconds', 'Время обработки события хендлером')
+handler_errors = Counter('bot_handler_errors_total', 'Исключения в хендлерах')
+
+llm_first_token_seconds = Histogram('llm_first_token_seconds', 'Время до первого фрагмента ответа LLM')
+llm_request_seconds = Histogram(
+    'llm_request_seconds', 'Время получения полного ответа LLM',
+    buckets=(0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+)
+llm_requests = Counter('llm_requests_total', 'Запросы к LLM по итогу (ok, incomplete, error)')
+llm_errors = Counter('llm_errors_total', 'Ошибки попыток запроса к LLM по провайдеру и причине')
+llm_tokens = Counter('llm_tokens_total', 'Токены LLM по данным провайдера (prompt, completion)')
+llm_waiting = Gauge('llm_waiting_requests', 'Запросы, ждущие свободного слота LLM')
+
+broadcast_messages = Counter('broadcast_messages_total', 'Сообщения рассылок по статусу доставки')
+broadcast_errors = Counter('broadcast_errors_total', 'Ошибки отправки рассылок по классу исключения')
+broadcast_retry_after = Counter('broadcast_retry_after_total', 'Ответы RetryAfter от Telegram при рассылках')
+
+lease_errors = Counter('lease_errors_total', 'Неудачные попытки захватить или продлить аренду роли')
+
+cache_requests = Counter('cache_requests_total', 'Обращения к кэшам по результату (hit, similar, miss)')
+cache_entries = Gauge('cache_entries', 'Записей в кэшах')
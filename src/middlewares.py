@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+from datetime import date
+from aiogram import BaseMiddleware
+
+from database import reactivate_user
+from metrics import handler_seconds, handler_errors
+from logs import log_context
+
+# Пользователи, уже возвращенные в рассылки этим процессом, -> день, за который они отмечены активными
+# (ограниченный LRU, чтобы не ходить в БД на каждое сообщение: запрос — раз в сутки на пользователя)
+_active_users = OrderedDict()
+ACTIVE_USERS_CACHE_SIZE = 100000
+
+
+def forget_active_users(user_ids):
+    """Сбросить отметку активности (пользователь заблокировал бота во время рассылки)"""
+    for user_id in user_ids:
+        _active_users.pop(user_id, None)
+
+
+class ReactivationMiddleware(BaseMiddleware):
+    """Снимает отметку о блокировке, когда пользователь снова пишет боту, и учитывает его в активных за день"""
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        pool = data.get('pool')
+        if user and pool:
+            today = date.today()
+            if _active_users.get(user.id) == today:
+                _active_users.move_to_end(user.id)
+            else:
+                async with pool.acquire() as conn:
+                    await reactivate_user(conn, user.id)
+                _active_users[user.id] = today
+                _active_users.move_to_end(user.id)
+                if len(_active_users) > ACTIVE_USERS_CACHE_SIZE:
+                    _active_users.popitem(last=False)
+        return await handler(event, data)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время работы и ошибки каждого хендлера (внутренний middleware: хендлер уже выбран фильтрами)"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = getattr(handler_object.callback, '__name__', 'unknown') if handler_object else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, handler=name)
+
+
+class CorrelationMiddleware(BaseMiddleware):
+    """Все записи лога, сделанные при обработке обновления, получают его update_id и user_id"""
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        with log_context(update_id=event.update_id, user_id=user.id if user else None):
+            return await handler(event, data)
@@ -0,0 +1,82 @@
+import importlib.util
+import logging
+import os
+import re
+
+import asyncpg
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+MIGRATION_NAME_RE = re.compile(r'^(\d+)_\w+\.(sql|py)$')
+# Ключ advisory-блокировки: миграции выполняет только одна реплика, остальные ждут
+MIGRATION_LOCK_ID = 726_173_001
+
+logger = logging.getLogger(__name__)
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Список миграций (версия, имя файла, путь) по возрастанию версии"""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_NAME_RE.match(filename)
+        if match:
+            migrations.append((int(match.group(1)), filename, os.path.join(directory, filename)))
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(versions) != len(set(versions)):
+        raise RuntimeError(f"Duplicate migration versions in {directory}")
+    return migrations
+
+
+async def get_applied_versions(conn):
+    try:
+        rows = await conn.fetch("SELECT version FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return set()
+    return {row['version'] for row in rows}
+
+
+async def apply_migration(conn, filename, path):
+    if filename.endswith('.sql'):
+        with open(path, 'r', encoding='utf-8') as f:
+            await conn.execute(f.read())
+    else:
+        spec = importlib.util.spec_from_file_location(f"migration_{filename[:-3]}", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        await module.upgrade(conn)
+
+
+async def migrate(conn, directory=MIGRATIONS_DIR):
+    """Применить новые миграции. Если схема актуальна — один SELECT без DDL и без блокировки.
+    Соединение не должно ограничивать время запросов: ожидание блокировки и перенос данных бывают долгими"""
+    migrations = load_migrations(directory)
+    applied = await get_applied_versions(conn)
+    if all(version in applied for version, _, _ in migrations):
+        return []
+
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+    try:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Пока ждали блокировку, другая реплика могла уже всё применить
+        applied = await get_applied_versions(conn)
+        done = []
+        for version, filename, path in migrations:
+            if version in applied:
+                continue
+            async with conn.transaction():
+                await apply_migration(conn, filename, path)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                    version, filename
+                )
+            logger.info("Applied migration %s", filename)
+            done.append(filename)
+        return done
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
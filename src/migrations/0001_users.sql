@@ -0,0 +1,24 @@
+-- Таблица пользователей с полем для подсчета вопросов
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT UNIQUE NOT NULL,
+    username VARCHAR(255),
+    full_name VARCHAR(255),
+    name VARCHAR(255),
+    period VARCHAR(255),
+    question_count INTEGER DEFAULT 0,
+    daily_support_enabled BOOLEAN DEFAULT FALSE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Колонка daily_support_enabled появилась позже (для БД, созданных до миграций)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS daily_support_enabled BOOLEAN DEFAULT FALSE;
+
+-- Состояние доставки: пользователи, заблокировавшие бота, исключаются из рассылок
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMP,
+    ADD COLUMN IF NOT EXISTS delivery_failures INTEGER DEFAULT 0;
+
+-- Частичный индекс под выборку подписчиков ежедневной поддержки
+CREATE INDEX IF NOT EXISTS idx_users_daily_support
+    ON users(user_id) WHERE daily_support_enabled AND blocked_at IS NULL;
@@ -0,0 +1,78 @@
+from datetime import date
+
+# Миграция заморожена: DDL записан здесь, а не берется из retention.py, чтобы правки кода не меняли её на новых БД
+PARTITIONS_AHEAD = 2
+
+
+def _month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def _next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+async def _create_partitions(conn, start):
+    """Помесячные партиции от месяца start до PARTITIONS_AHEAD месяцев после текущего"""
+    month = _month_start(start)
+    last = _month_start(date.today())
+    for _ in range(PARTITIONS_AHEAD):
+        last = _next_month(last)
+    while month <= last:
+        await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS message_history_p{month:%Y%m}
+            PARTITION OF message_history
+            FOR VALUES FROM ('{month}') TO ('{_next_month(month)}')
+        ''')
+        month = _next_month(month)
+
+
+async def upgrade(conn):
+    """История сообщений (для контекста диалога), помесячно партиционированная по created_at.
+    Обычная таблица из БД, созданных до партиционирования, переносится в партиции"""
+    relkind = await conn.fetchval(
+        "SELECT relkind::text FROM pg_class WHERE relname = 'message_history' AND relnamespace = 'public'::regnamespace"
+    )
+    if relkind == 'p':
+        return
+
+    if relkind == 'r':
+        # Освобождаем имена таблицы, последовательности и индексов для новой таблицы
+        await conn.execute('ALTER TABLE message_history RENAME TO message_history_legacy')
+        await conn.execute('ALTER SEQUENCE IF EXISTS message_history_id_seq RENAME TO message_history_legacy_id_seq')
+        await conn.execute('ALTER INDEX IF EXISTS message_history_pkey RENAME TO message_history_legacy_pkey')
+        await conn.execute('ALTER INDEX IF EXISTS idx_message_history_user_id RENAME TO idx_message_history_legacy_user_id')
+
+    # BIGSERIAL: int4-идентификаторы рано или поздно закончатся
+    await conn.execute('''
+        CREATE TABLE message_history (
+            id BIGSERIAL,
+            user_id BIGINT NOT NULL,
+            role VARCHAR(10) NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    ''')
+    # Индекс создается в каждой партиции: поиск истории пользователя остается коротким при любом размере таблицы
+    await conn.execute('''
+        CREATE INDEX idx_message_history_user_id
+        ON message_history(user_id, created_at DESC)
+    ''')
+
+    if relkind != 'r':
+        await _create_partitions(conn, date.today())
+        return
+
+    oldest = await conn.fetchval('SELECT MIN(created_at) FROM message_history_legacy')
+    await _create_partitions(conn, min(oldest.date(), date.today()) if oldest else date.today())
+    await conn.execute('''
+        INSERT INTO message_history (id, user_id, role, content, created_at)
+        SELECT id, user_id, role, content, COALESCE(created_at, CURRENT_TIMESTAMP)
+        FROM message_history_legacy
+    ''')
+    await conn.execute('''
+        SELECT setval(pg_get_serial_sequence('message_history', 'id'), COALESCE(MAX(id), 0) + 1, false)
+        FROM message_history
+    ''')
+    await conn.execute('DROP TABLE message_history_legacy')
@@ -0,0 +1,7 @@
+-- Сжатое содержание старой части диалога (история до summarized_until_id уже свернута в summary)
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    user_id BIGINT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    summarized_until_id BIGINT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,23 @@
+-- Задания рассылок: payload хранит только file_id/текст/entities, чтобы задание можно было продолжить после рестарта
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id SERIAL PRIMARY KEY,
+    kind VARCHAR(32) NOT NULL,
+    dedup_key VARCHAR(255) UNIQUE,
+    payload JSONB NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'running',
+    status_chat_id BIGINT,
+    status_message_id BIGINT,
+    sent_count INTEGER DEFAULT 0,
+    blocked_count INTEGER DEFAULT 0,
+    failed_count INTEGER DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+-- Состояние доставки для каждого получателя (удаляется после завершения задания)
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    PRIMARY KEY (job_id, user_id)
+);
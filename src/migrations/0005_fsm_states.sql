@@ -0,0 +1,7 @@
+-- Состояния FSM aiogram: переживают рестарт и общие для всех реплик бота
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key VARCHAR(255) PRIMARY KEY,
+    state VARCHAR(255),
+    data JSONB NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,31 @@
+-- Аренды ролей между репликами (лидер планировщика и т.п.): роль принадлежит holder, пока не истек expires_at
+CREATE TABLE IF NOT EXISTS leases (
+    name VARCHAR(64) PRIMARY KEY,
+    holder VARCHAR(128) NOT NULL,
+    expires_at TIMESTAMP NOT NULL
+);
+
+-- Части рассылки по диапазонам user_id: каждую часть в данный момент отправляет одна реплика.
+-- Если реплика упала, её аренда истекает и часть забирает другая
+CREATE TABLE IF NOT EXISTS broadcast_shards (
+    job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+    shard INTEGER NOT NULL,
+    first_user_id BIGINT NOT NULL,
+    last_user_id BIGINT NOT NULL,
+    holder VARCHAR(128),
+    lease_until TIMESTAMP,
+    done BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (job_id, shard)
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcast_shards_open
+ON broadcast_shards(job_id, shard) WHERE NOT done;
+
+-- Незавершенные задания, созданные до разбиения на части, становятся одной частью
+INSERT INTO broadcast_shards (job_id, shard, first_user_id, last_user_id)
+SELECT d.job_id, 0, MIN(d.user_id), MAX(d.user_id)
+FROM broadcast_deliveries d
+JOIN broadcast_jobs j ON j.id = d.job_id
+WHERE j.status = 'running'
+GROUP BY d.job_id
+ON CONFLICT DO NOTHING;
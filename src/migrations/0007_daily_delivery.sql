@@ -0,0 +1,31 @@
+-- Ежедневная поддержка по местному времени пользователя.
+-- Отправки размазаны по окну: пользователь получает сообщение в delivery_time + (user_id % окно) минут
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS timezone VARCHAR(64) NOT NULL DEFAULT 'Europe/Moscow',
+    ADD COLUMN IF NOT EXISTS delivery_time TIME NOT NULL DEFAULT '09:00',
+    -- С часовым поясом: момент доставки сравнивается с текущим временем независимо от TZ сервера
+    ADD COLUMN IF NOT EXISTS next_delivery_at TIMESTAMPTZ;
+
+-- Ближайший момент доставки строго после after: местная дата + время + сдвиг пользователя внутри окна
+CREATE OR REPLACE FUNCTION next_daily_delivery(
+    tz TEXT, at_time TIME, user_id BIGINT, window_minutes INTEGER, after TIMESTAMPTZ
+) RETURNS TIMESTAMPTZ LANGUAGE sql STABLE AS $$
+    SELECT CASE
+        WHEN (local.day + at_time) AT TIME ZONE tz + local.shift > after
+            THEN (local.day + at_time) AT TIME ZONE tz + local.shift
+        ELSE (local.day + 1 + at_time) AT TIME ZONE tz + local.shift
+    END
+    FROM (
+        SELECT (after AT TIME ZONE tz)::date AS day,
+               make_interval(mins => (user_id % GREATEST(window_minutes, 1))::integer) AS shift
+    ) AS local
+$$;
+
+-- Каждый тик планировщика — короткий диапазонный запрос по этому индексу
+CREATE INDEX IF NOT EXISTS idx_users_next_delivery
+    ON users(next_delivery_at) WHERE daily_support_enabled AND blocked_at IS NULL;
+
+-- Подписчикам назначается ближайшая доставка (окно по умолчанию — 60 минут, как DAILY_SEND_WINDOW)
+UPDATE users
+SET next_delivery_at = next_daily_delivery(timezone, delivery_time, user_id, 60, CURRENT_TIMESTAMP)
+WHERE daily_support_enabled AND next_delivery_at IS NULL;
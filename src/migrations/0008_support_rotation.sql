@@ -0,0 +1,7 @@
+-- Персональная ротация ежедневной поддержки: битовая маска показанных сообщений каталога и число отправленных
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS support_seen BYTEA NOT NULL DEFAULT '\x',
+    ADD COLUMN IF NOT EXISTS support_count INTEGER NOT NULL DEFAULT 0;
+
+-- Свой текст для получателя рассылки (NULL — общий payload задания)
+ALTER TABLE broadcast_deliveries ADD COLUMN IF NOT EXISTS payload JSONB;
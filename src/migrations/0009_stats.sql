@@ -0,0 +1,45 @@
+-- Счетчики для /stats обновляются теми же запросами, что меняют users, поэтому /stats не сканирует users.
+-- Строки разбиты на слоты (user_id % STATS_SLOTS): параллельные обновления не ждут блокировку одной строки,
+-- при чтении слоты суммируются
+
+-- Итоги по периодам ('' — период не выбран): пользователи, вопросы, подписчики ежедневной поддержки
+CREATE TABLE IF NOT EXISTS stats_period (
+    period VARCHAR(255) NOT NULL,
+    slot SMALLINT NOT NULL,
+    users BIGINT NOT NULL DEFAULT 0,
+    questions BIGINT NOT NULL DEFAULT 0,
+    subscribers BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (period, slot)
+);
+
+-- Ряды по дням: новые и активные пользователи, вопросы, подписки/отписки, блокировки и возвраты
+CREATE TABLE IF NOT EXISTS stats_daily (
+    day DATE NOT NULL,
+    slot SMALLINT NOT NULL,
+    new_users INTEGER NOT NULL DEFAULT 0,
+    active_users INTEGER NOT NULL DEFAULT 0,
+    questions INTEGER NOT NULL DEFAULT 0,
+    subscribed INTEGER NOT NULL DEFAULT 0,
+    unsubscribed INTEGER NOT NULL DEFAULT 0,
+    blocked INTEGER NOT NULL DEFAULT 0,
+    returned INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, slot)
+);
+
+-- День последней активности: пользователь попадает в active_users один раз в сутки
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_active_on DATE;
+
+-- Начальные значения из текущих данных (16 слотов, как STATS_SLOTS по умолчанию)
+INSERT INTO stats_period (period, slot, users, questions, subscribers)
+SELECT COALESCE(period, ''), user_id % 16, COUNT(*), COALESCE(SUM(question_count), 0),
+       COUNT(*) FILTER (WHERE daily_support_enabled)
+FROM users
+GROUP BY 1, 2
+ON CONFLICT (period, slot) DO NOTHING;
+
+INSERT INTO stats_daily (day, slot, new_users)
+SELECT created_at::date, user_id % 16, COUNT(*)
+FROM users
+WHERE created_at IS NOT NULL
+GROUP BY 1, 2
+ON CONFLICT (day, slot) DO NOTHING;
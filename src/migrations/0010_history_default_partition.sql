@@ -0,0 +1,3 @@
+-- Партиция по умолчанию для message_history: строки месяцев, для которых лидер еще не создал партицию,
+-- попадают сюда, и вставка в историю не падает. retention.create_month_partition переносит их в партицию месяца
+CREATE TABLE IF NOT EXISTS message_history_default PARTITION OF message_history DEFAULT;
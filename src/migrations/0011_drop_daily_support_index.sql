@@ -0,0 +1,3 @@
+-- Подписчиков ежедневной поддержки выбирает idx_users_next_delivery (миграция 0007), этот индекс больше не читается,
+-- а каждая запись в users, которая не может быть HOT-обновлением (например, при доставке), обновляет и его
+DROP INDEX IF EXISTS idx_users_daily_support;
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from collections import Counter, deque
+from aiogram import Bot
+
+from config import ADMINS, ADMIN_DIGEST_INTERVAL, ADMIN_DIGEST_SIZE, ADMIN_QUEUE_LIMIT
+from broadcast import limiter
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+# Длина события в сводке под нагрузкой
+SUMMARY_EVENT_LENGTH = 300
+KIND_TITLES = {
+    'question': '❓ Вопросов',
+    'feedback': '💬 Отзывов',
+}
+
+
+def _chunks(parts, separator='\n\n———\n\n', limit=MESSAGE_LIMIT):
+    """Склеить части в сообщения не длиннее limit (слишком длинная часть обрезается)"""
+    chunk = ''
+    for part in parts:
+        part = part[:limit]
+        if chunk and len(chunk) + len(separator) + len(part) > limit:
+            yield chunk
+            chunk = ''
+        chunk = chunk + separator + part if chunk else part
+    if chunk:
+        yield chunk
+
+
+class AdminNotifier:
+    """Очередь уведомлений админам: обработчик только кладет событие, отправка идет в фоне пачками.
+    Раз в interval секунд админ получает дайджест; если событий больше size — сводку со счетчиками"""
+
+    def __init__(self, interval=ADMIN_DIGEST_INTERVAL, size=ADMIN_DIGEST_SIZE, queue_limit=ADMIN_QUEUE_LIMIT):
+        self.interval = interval
+        self.size = size
+        # Самые старые события вытесняются, но учитываются в счетчиках
+        self._events = deque(maxlen=queue_limit)
+        self._counts = Counter()
+
+    def notify(self, kind, text):
+        if not ADMINS:
+            return
+        self._events.append(text)
+        self._counts[kind] += 1
+
+    def digest(self):
+        """Забрать накопленные события и собрать сообщения дайджеста"""
+        events, self._events = list(self._events), deque(maxlen=self._events.maxlen)
+        counts, self._counts = self._counts, Counter()
+        total = sum(counts.values())
+        if not total:
+            return []
+        if total <= self.size:
+            return list(_chunks(events))
+
+        lines = [f"📋 Сводка за {self.interval:g} с: событий {total}, показаны последние {min(self.size, len(events))}"]
+        lines += [f"{KIND_TITLES.get(kind, kind)}: {count}" for kind, count in counts.most_common()]
+        recent = [
+            event if len(event) <= SUMMARY_EVENT_LENGTH else event[:SUMMARY_EVENT_LENGTH] + '…'
+            for event in events[-self.size:]
+        ]
+        return list(_chunks(['\n'.join(lines)] + recent))
+
+    async def flush(self, bot: Bot):
+        for text in self.digest():
+            for admin_id in ADMINS:
+                try:
+                    # Общий лимитер с рассылками: уведомления не выбивают бота за лимиты Telegram
+                    await limiter.acquire(admin_id)
+                    await bot.send_message(admin_id, text)
+                except Exception as e:
+                    logger.warning("Ошибка при отправке уведомления админу %s: %s", admin_id, e)
+
+    async def run(self, bot: Bot):
+        """Фоновая задача отправки дайджестов"""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush(bot)
+
+
+notifier = AdminNotifier()
@@ -0,0 +1,45 @@
+import asyncio
+
+from config import QUESTION_DEBOUNCE, QUESTION_MAX_PENDING
+
+
+class QuestionGuard:
+    """Не больше одного запроса к LLM на пользователя одновременно.
+    Сообщения, пришедшие подряд (в пределах debounce секунд или пока готовится ответ), склеиваются в один вопрос"""
+
+    def __init__(self, debounce=QUESTION_DEBOUNCE, max_pending=QUESTION_MAX_PENDING):
+        self.debounce = debounce
+        self.max_pending = max_pending
+        # user_id -> тексты, ожидающие ответа; ключ есть, пока у пользователя идет обработка
+        self._pending = {}
+
+    def add(self, user_id, text):
+        """Поставить сообщение в очередь пользователя.
+        True — вызывающий обработчик отвечает на вопросы (см. rounds), False — сообщение войдет в уже идущую обработку,
+        None — очередь переполнена"""
+        pending = self._pending.get(user_id)
+        if pending is None:
+            self._pending[user_id] = [text]
+            return True
+        if len(pending) >= self.max_pending:
+            return None
+        pending.append(text)
+        return False
+
+    async def rounds(self, user_id):
+        """Склеенные вопросы пользователя по очереди; следующий — только после ответа на предыдущий.
+        Итерировать через contextlib.aclosing: очередь пользователя освобождается при закрытии генератора"""
+        try:
+            while True:
+                if self.debounce:
+                    await asyncio.sleep(self.debounce)
+                texts = self._pending[user_id]
+                if not texts:
+                    return
+                self._pending[user_id] = []
+                yield "\n".join(texts)
+        finally:
+            self._pending.pop(user_id, None)
+
+
+question_guard = QuestionGuard()
@@ -0,0 +1,89 @@
+import random
+import time
+
+from config import (
+    LLM_BREAKER_FAILURES, LLM_BREAKER_RESET, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY
+)
+
+# Статусы, при которых запрос к LLM имеет смысл повторить
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """Ошибка ответа провайдера LLM (HTTP-статус и, если есть, Retry-After в секундах)"""
+
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"LLM provider returned HTTP {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status in RETRYABLE_STATUSES
+
+
+class CircuitBreaker:
+    """Размыкатель: после failures ошибок подряд провайдер считается недоступным reset секунд.
+    Затем пропускается один пробный запрос: успех замыкает цепь, ошибка снова размыкает"""
+
+    def __init__(self, failures=LLM_BREAKER_FAILURES, reset=LLM_BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self._failed = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at < self.reset:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def release_probe(self):
+        """Пробный запрос завершился без результата (отменен, ошибка запроса): следующий вызов снова может пробовать"""
+        self._probing = False
+
+    def record_success(self):
+        self._failed = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self._failed += 1
+        if self._probing or self._failed >= self.failures:
+            self._opened_at = time.monotonic()
+        self._probing = False
+
+
+class Provider:
+    """OpenAI-совместимый провайдер LLM (адрес, ключ, модель) со своим размыкателем"""
+
+    def __init__(self, name, url, api_key, model, breaker=None):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+        self.breaker = breaker or CircuitBreaker()
+
+    @property
+    def headers(self):
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+
+def retry_delay(attempt, retry_after=None, base=LLM_RETRY_BASE_DELAY, cap=LLM_RETRY_MAX_DELAY):
+    """Пауза перед повтором attempt (с 1): экспонента с полным джиттером; Retry-After провайдера учитывается"""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap))
+    return delay
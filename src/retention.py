@@ -0,0 +1,180 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+from datetime import date, datetime, timedelta
+
+from config import (
+    HISTORY_RETENTION_DAYS, HISTORY_ARCHIVE_DIR, HISTORY_MAX_PER_USER,
+    HISTORY_PARTITIONS_AHEAD, RETENTION_INTERVAL
+)
+from database import maintenance_connection
+
+# Помесячные партиции message_history: message_history_p202601 содержит январь 2026
+PARTITION_PREFIX = 'message_history_p'
+PARTITION_NAME_RE = re.compile(rf'^{PARTITION_PREFIX}(\d{{4}})(\d{{2}})$')
+# Сюда попадают строки месяцев без своей партиции: вставка в историю не падает, даже если лидер давно не создавал партиции.
+# Создается миграцией 0010
+DEFAULT_PARTITION = 'message_history_default'
+ARCHIVE_BATCH_SIZE = 5000
+
+logger = logging.getLogger(__name__)
+
+
+def _month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def _next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+
+async def _table_exists(conn, name):
+    # Запрос к pg_class, а не to_regclass: кэш каталога может не увидеть таблицу, только что созданную другой репликой
+    return await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM pg_class WHERE relname = $1 AND relnamespace = 'public'::regnamespace)", name
+    )
+
+
+async def create_month_partition(conn, month):
+    name = f"{PARTITION_PREFIX}{month:%Y%m}"
+    if await _table_exists(conn, name):
+        return
+    async with conn.transaction():
+        # Реплики создают партиции при старте одновременно
+        await conn.execute("SELECT pg_advisory_xact_lock(hashtext('message_history_partitions'))")
+        if await _table_exists(conn, name):
+            return
+        # CREATE TABLE ... PARTITION OF падает, если строки этого месяца уже лежат в DEFAULT:
+        # сначала переносим их в отдельную таблицу, затем подключаем её партицией
+        await conn.execute(f'CREATE TABLE {name} (LIKE message_history INCLUDING DEFAULTS)')
+        await conn.execute(f'''
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION}
+                WHERE created_at >= $1 AND created_at < $2
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+        ''', month, _next_month(month))
+        await conn.execute(f'''
+            ALTER TABLE message_history ATTACH PARTITION {name}
+            FOR VALUES FROM ('{month}') TO ('{_next_month(month)}')
+        ''')
+
+
+async def ensure_partitions(conn, start=None, ahead=HISTORY_PARTITIONS_AHEAD):
+    """Создать партиции от месяца start (по умолчанию текущего) и на ahead месяцев вперед"""
+    month = _month_start(start or date.today())
+    last = _month_start(date.today())
+    for _ in range(ahead):
+        last = _next_month(last)
+    while month <= last:
+        await create_month_partition(conn, month)
+        month = _next_month(month)
+
+
+async def get_expired_partitions(conn, cutoff):
+    """Партиции, целиком лежащие раньше cutoff"""
+    rows = await conn.fetch('''
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'message_history'::regclass
+    ''')
+    expired = []
+    for row in rows:
+        match = PARTITION_NAME_RE.match(row['relname'])
+        if match and _next_month(date(int(match.group(1)), int(match.group(2)), 1)) <= cutoff:
+            expired.append(row['relname'])
+    return sorted(expired)
+
+
+def _write_batch(archive, batch):
+    for row in batch:
+        archive.write(json.dumps(row, ensure_ascii=False, default=str).encode('utf-8') + b'\n')
+
+
+async def archive_partition(conn, name, archive_dir=HISTORY_ARCHIVE_DIR):
+    """Выгрузить партицию в сжатый JSONL и удалить её"""
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.jsonl.gz")
+    tmp_path = path + '.tmp'
+
+    # Запись в файл идет в потоке, чтобы сжатие не блокировало цикл событий
+    archive = await asyncio.to_thread(gzip.open, tmp_path, 'wb')
+    try:
+        async with conn.transaction():
+            batch = []
+            async for record in conn.cursor(
+                f'SELECT id, user_id, role, content, created_at FROM {name} ORDER BY id',
+                prefetch=ARCHIVE_BATCH_SIZE
+            ):
+                batch.append(dict(record))
+                if len(batch) >= ARCHIVE_BATCH_SIZE:
+                    await asyncio.to_thread(_write_batch, archive, batch)
+                    batch = []
+            if batch:
+                await asyncio.to_thread(_write_batch, archive, batch)
+    finally:
+        await asyncio.to_thread(archive.close)
+    os.replace(tmp_path, path)
+
+    async with conn.transaction():
+        await conn.execute(f'ALTER TABLE message_history DETACH PARTITION {name}')
+        await conn.execute(f'DROP TABLE {name}')
+    return path
+
+
+async def trim_user_history(conn, max_per_user=HISTORY_MAX_PER_USER, active_within=2 * RETENTION_INTERVAL):
+    """Оставить не больше max_per_user последних сообщений у пользователей, писавших за последние active_within секунд.
+    Превысить лимит можно только новыми сообщениями, поэтому остальных пользователей проверять не нужно"""
+    if max_per_user <= 0:
+        return
+    # Условие на created_at отсекает старые партиции; лишние сообщения каждого пользователя ищутся по индексу (user_id, created_at)
+    await conn.execute('''
+        DELETE FROM message_history m
+        USING (
+            SELECT extra.id, extra.created_at
+            FROM (
+                SELECT DISTINCT user_id
+                FROM message_history
+                WHERE created_at >= LOCALTIMESTAMP - make_interval(secs => $2)
+            ) active
+            CROSS JOIN LATERAL (
+                SELECT id, created_at
+                FROM message_history
+                WHERE user_id = active.user_id
+                ORDER BY created_at DESC, id DESC
+                OFFSET $1
+            ) extra
+        ) old
+        WHERE m.id = old.id AND m.created_at = old.created_at
+    ''', max_per_user, active_within)
+
+
+async def run_retention():
+    """Один проход обслуживания: партиции вперед, архив старых месяцев, лимит на пользователя.
+    Идет на отдельном соединении: выгрузка партиций и чистка истории дольше DB_COMMAND_TIMEOUT"""
+    async with maintenance_connection() as conn:
+        await ensure_partitions(conn)
+        cutoff = (datetime.now() - timedelta(days=HISTORY_RETENTION_DAYS)).date()
+        for name in await get_expired_partitions(conn, cutoff):
+            await archive_partition(conn, name)
+            logger.info("Партиция %s выгружена в архив", name)
+        await trim_user_history(conn)
+
+
+async def schedule_retention(leader):
+    """Фоновая задача обслуживания истории сообщений (выполняет только реплика-лидер)"""
+    while True:
+        if not leader.held:
+            # Ждем, пока роль лидера не перейдет к этой реплике
+            await asyncio.sleep(leader.ttl)
+            continue
+        try:
+            await run_retention()
+        except Exception:
+            logger.exception("Ошибка обслуживания истории сообщений")
+        await asyncio.sleep(RETENTION_INTERVAL)
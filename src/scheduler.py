@@ -1,52 +1,48 @@
 import asyncio
-from datetime import datetime, time
+import logging
+import time
 from aiogram import Bot
-from database import get_users_with_daily_support
-from daily_support import get_today_message
-from config import BOT_TOKEN
+from database import claim_due_daily_deliveries, save_support_rotation, create_broadcast_job
+from daily_support import catalog, get_today_message
+from broadcast import run_job
+from config import DAILY_TICK_INTERVAL
+from utils import spawn
+
+logger = logging.getLogger(__name__)
 
 async def send_daily_messages(bot: Bot, pool):
-    """Отправка ежедневных сообщений поддержки всем пользователям с включенной поддержкой"""
+    """Отправка ежедневных сообщений поддержки тем, у кого наступило выбранное время.
+    Каждый получает следующее сообщение своей ротации (по теме, подходящей его периоду)"""
+    # Выборка получателей, их ротации и создание задания в одной транзакции: следующая доставка уже назначена,
+    # поэтому после рестарта или на другой реплике эти пользователи не получат сообщение повторно
     async with pool.acquire() as conn:
-        user_ids = await get_users_with_daily_support(conn)
-    
-    if not user_ids:
-        return
-    
-    message = get_today_message()
-    success_count = 0
-    failed_count = 0
-    
-    for user_id in user_ids:
-        try:
-            await bot.send_message(chat_id=user_id, text=message)
-            success_count += 1
-        except Exception as e:
-            failed_count += 1
-            #print(f"Ошибка при отправке ежедневного сообщения пользователю {user_id}: {e}")
-    
-    #print(f"Ежедневные сообщения отправлены: успешно {success_count}, ошибок {failed_count}")
+        async with conn.transaction():
+            due = await claim_due_daily_deliveries(conn)
+            if not due:
+                return
+            # Все сообщения выбираются в памяти за один проход, без запросов на каждого пользователя
+            rendered = catalog.render(due)
+            await save_support_rotation(conn, [(user_id, seen, count) for user_id, _, seen, count in rendered])
+            job_id = await create_broadcast_job(
+                conn, 'daily', {'type': 'text', 'text': get_today_message()},
+                [user_id for user_id, _, _, _ in rendered],
+                payloads=[{'type': 'text', 'text': message} for _, message, _, _ in rendered]
+            )
 
-async def schedule_daily_messages(bot: Bot, pool):
-    """Планировщик для отправки ежедневных сообщений в 9:00"""
+    logger.info("Ежедневные сообщения: задание %s, получателей %s", job_id, len(rendered))
+    # Не ждем окончания отправки: следующий тик должен начаться вовремя
+    spawn(run_job(bot, pool, job_id))
+
+async def schedule_daily_messages(bot: Bot, pool, leader):
+    """Планировщик ежедневных сообщений: раз в минуту отправляет очередной слот (запускает только реплика-лидер).
+    Пользователи распределены по слотам окна DAILY_SEND_WINDOW, поэтому нагрузка ровная, без пика в 9:00"""
     while True:
-        now = datetime.now()
-        target_time = time(9, 0)  # 9:00
-        
-        # Вычисляем время до следующего 9:00
-        if now.time() < target_time:
-            # Сегодня еще не было 9:00
-            next_run = datetime.combine(now.date(), target_time)
-        else:
-            # Сегодня уже было 9:00, планируем на завтра
-            from datetime import timedelta
-            next_run = datetime.combine(now.date() + timedelta(days=1), target_time)
-        
-        wait_seconds = (next_run - now).total_seconds()
-        #print(f"Следующая отправка ежедневных сообщений: {next_run} (через {wait_seconds/3600:.1f} часов)")
-        
-        await asyncio.sleep(wait_seconds)
-        
-        # Отправляем сообщения
-        await send_daily_messages(bot, pool)
+        # Тики выравниваются по началу минуты
+        await asyncio.sleep(DAILY_TICK_INTERVAL - time.time() % DAILY_TICK_INTERVAL)
 
+        if not leader.held:
+            continue
+        try:
+            await send_daily_messages(bot, pool)
+        except Exception:
+            logger.exception("Ошибка отправки ежедневных сообщений")
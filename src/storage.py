@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from contextlib import suppress
+from aiogram import Bot
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from config import FSM_CACHE_SIZE, FSM_CACHE_TTL, FSM_FLUSH_INTERVAL, FSM_FLUSH_RETRY_MAX
+from database import get_fsm_record, save_fsm_records
+from metrics import cache_requests, cache_entries
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresStorage(BaseStorage):
+    """FSM-хранилище в PostgreSQL: чтение через LRU-кэш, запись откладывается и объединяется в пачки.
+    Несколько изменений одного ключа между сбросами дают одну запись в БД"""
+
+    def __init__(self, pool, cache_size=FSM_CACHE_SIZE, ttl=FSM_CACHE_TTL, flush_interval=FSM_FLUSH_INTERVAL):
+        self.pool = pool
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # key -> (истекает, state, data)
+        self._cache = OrderedDict()
+        # Несохраненные изменения: key -> (state, data)
+        self._dirty = {}
+        self._flusher = None
+        self.hits = 0
+        self.misses = 0
+        cache_requests.track(lambda: self.hits, cache='fsm', result='hit')
+        cache_requests.track(lambda: self.misses, cache='fsm', result='miss')
+        cache_entries.track(lambda: len(self._cache), cache='fsm')
+        cache_entries.track(lambda: len(self._dirty), cache='fsm_dirty')
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.destiny}"
+
+    async def _load(self, key: StorageKey):
+        name = self._key(key)
+        if name in self._dirty:
+            self.hits += 1
+            return self._dirty[name]
+        item = self._cache.get(name)
+        if item is not None and item[0] >= time.monotonic():
+            self._cache.move_to_end(name)
+            self.hits += 1
+            return item[1], item[2]
+        self.misses += 1
+        async with self.pool.acquire() as conn:
+            record = await get_fsm_record(conn, name)
+        state, data = record if record else (None, {})
+        self._remember(name, state, data)
+        return state, data
+
+    def _remember(self, name, state, data):
+        self._cache[name] = (time.monotonic() + self.ttl, state, data)
+        self._cache.move_to_end(name)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _store(self, key: StorageKey, state, data):
+        name = self._key(key)
+        self._remember(name, state, data)
+        self._dirty[name] = (state, data)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Пока задача жива, _store не создает новую: она пишет всё, что накопилось, в том числе за время записи
+        delay = self.flush_interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+            except Exception:
+                delay = min(max(delay * 2, 1), FSM_FLUSH_RETRY_MAX)
+                logger.exception("Ошибка записи состояний FSM (%s ключей), повтор через %.0f с", len(self._dirty), delay)
+                continue
+            if not self._dirty:
+                return
+            delay = self.flush_interval
+
+    async def flush(self):
+        """Записать накопленные изменения в БД одним запросом"""
+        dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        try:
+            async with self.pool.acquire() as conn:
+                await save_fsm_records(conn, [(name, state, data) for name, (state, data) in dirty.items()])
+        except BaseException:
+            # Не теряем изменения (в том числе при отмене задачи): более новые значения из _dirty важнее старых
+            self._dirty = {**dirty, **self._dirty}
+            raise
+
+    async def set_state(self, bot: Bot, key: StorageKey, state=None) -> None:
+        _, data = await self._load(key)
+        await self._store(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, bot: Bot, key: StorageKey):
+        state, _ = await self._load(key)
+        return state
+
+    async def set_data(self, bot: Bot, key: StorageKey, data) -> None:
+        state, _ = await self._load(key)
+        await self._store(key, state, data.copy())
+
+    async def get_data(self, bot: Bot, key: StorageKey):
+        _, data = await self._load(key)
+        return data.copy()
+
+    async def close(self) -> None:
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+            # Прерванная запись возвращает изменения в _dirty: финальный flush должен начаться после этого
+            with suppress(asyncio.CancelledError):
+                await self._flusher
+        await self.flush()
@@ -0,0 +1,79 @@
+import re
+from collections import namedtuple
+
+from config import TRIGGER_WORDS
+
+TriggerMatch = namedtuple('TriggerMatch', ['word', 'start', 'end'])
+
+
+def _trie_pattern(words):
+    """Собрать регулярное выражение-дерево: общие префиксы основ проверяются один раз"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def build(node):
+        end = '' in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # Более короткая основа тоже совпадение: делаем продолжение необязательным
+        return f'(?:{body})?' if end else body
+
+    return build(trie)
+
+
+def compile_triggers(words):
+    """Скомпилировать основы слов в одно выражение: совпадение только с начала слова"""
+    stems = sorted({word.lower() for word in words if word})
+    if not stems:
+        return None
+    return re.compile(r'(?<!\w)(' + _trie_pattern(stems) + ')', re.IGNORECASE)
+
+
+_pattern = compile_triggers(TRIGGER_WORDS)
+
+
+def find_trigger(text: str, pattern=None):
+    """Найти первое тревожное слово в тексте: возвращает основу и позицию или None"""
+    pattern = pattern or _pattern
+    if not text or pattern is None:
+        return None
+    match = pattern.search(text)
+    if not match:
+        return None
+    return TriggerMatch(match.group(1).lower(), match.start(1), match.end(1))
+
+
+if __name__ == "__main__":
+    # Микробенчмарк: python triggers.py
+    import random
+    import timeit
+
+    random.seed(1)
+    alphabet = 'абвгдежзийклмнопрстуфхцчшщыэюя'
+    stems = list(TRIGGER_WORDS) + [
+        ''.join(random.choice(alphabet) for _ in range(random.randint(4, 9))) for _ in range(300)
+    ]
+    texts = [
+        "Подскажи, пожалуйста, как наладить сон малыша и не сойти с ума от недосыпа?",
+        "Небольшой вопрос: можно ли беременным пить кофе по утрам?",
+        "У ребенка поднялась температура и он отказывается есть",
+    ] * 100
+    pattern = compile_triggers(stems)
+
+    def naive():
+        for text in texts:
+            any(re.search(rf'\b{word}', text.lower()) for word in stems)
+
+    def compiled():
+        for text in texts:
+            find_trigger(text, pattern)
+
+    for name, func in (('per-word re.search', naive), ('compiled trie', compiled)):
+        seconds = min(timeit.repeat(func, number=5, repeat=3)) / 5
+        print(f"{name:>20}: {seconds / len(texts) * 1e6:8.1f} мкс на сообщение ({len(stems)} основ)")
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+
+import database
+from config import USER_CACHE_SIZE, USER_CACHE_TTL
+from metrics import cache_requests, cache_entries
+
+
+class UserCache:
+    """LRU-кэш профилей пользователей (name, period, daily_support_enabled, timezone, delivery_time, question_count)"""
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._profiles = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Счетчики уже есть в объекте: метрики читают их при экспорте
+        cache_requests.track(lambda: self.hits, cache='user', result='hit')
+        cache_requests.track(lambda: self.misses, cache='user', result='miss')
+        cache_entries.track(lambda: len(self._profiles), cache='user')
+
+    def get(self, user_id):
+        item = self._profiles.get(user_id)
+        if item is None or item[0] < time.monotonic():
+            self._profiles.pop(user_id, None)
+            self.misses += 1
+            return None
+        self._profiles.move_to_end(user_id)
+        self.hits += 1
+        return item[1]
+
+    def set(self, user_id, profile):
+        self._profiles[user_id] = (time.monotonic() + self.ttl, profile)
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+    def update(self, user_id, **fields):
+        """Обновить поля закэшированного профиля (если он есть в кэше)"""
+        item = self._profiles.get(user_id)
+        if item is not None:
+            item[1].update(fields)
+
+    def invalidate(self, user_id):
+        self._profiles.pop(user_id, None)
+
+
+user_cache = UserCache()
+
+
+async def get_user(pool, user_id):
+    """Профиль пользователя из кэша; в БД идем только при промахе (соединение из пула не берется)"""
+    profile = user_cache.get(user_id)
+    if profile is None:
+        async with pool.acquire() as conn:
+            profile = await database.get_user_profile(conn, user_id)
+        if profile is not None:
+            user_cache.set(user_id, profile)
+    return profile
+
+
+async def save_user(conn, user_id, username, full_name, name):
+    await database.save_user(conn, user_id, username, full_name, name)
+    user_cache.invalidate(user_id)
+
+
+async def update_user_period(conn, user_id, period):
+    await database.update_user_period(conn, user_id, period)
+    user_cache.update(user_id, period=period)
+
+
+async def toggle_daily_support(conn, user_id, enabled):
+    await database.toggle_daily_support(conn, user_id, enabled)
+    user_cache.update(user_id, daily_support_enabled=enabled)
+
+
+async def set_daily_delivery_time(conn, user_id, timezone, delivery_time):
+    await database.set_daily_delivery_time(conn, user_id, timezone, delivery_time)
+    user_cache.update(user_id, timezone=timezone, delivery_time=delivery_time)
+
+
+async def start_question(conn, user_id, history_limit=10):
+    """Счетчик вопросов и история одним запросом (UPDATE ... RETURNING); кэш получает новое значение счетчика"""
+    question_count, summary, history = await database.start_question(conn, user_id, history_limit)
+    if question_count is not None:
+        user_cache.update(user_id, question_count=question_count)
+    return question_count, summary, history
@@ -1,23 +1,334 @@
+import asyncio
 import aiohttp
-import re
-from config import DEEPSEEK_API_KEY, TRIGGER_WORDS
+import json
+import logging
+from contextlib import asynccontextmanager
+from answer_cache import AnswerCache
+from config import (
+    DEEPSEEK_API_KEY, DEEPSEEK_URL, DEEPSEEK_MODEL, LLM_POOL_SIZE,
+    LLM_KEEPALIVE_TIMEOUT, LLM_DNS_CACHE_TTL, LLM_CONNECT_TIMEOUT, LLM_READ_TIMEOUT, SUMMARY_MAX_TOKENS,
+    LLM_MAX_CONCURRENCY, LLM_MAX_WAITING, LLM_ATTEMPT_TIMEOUT, LLM_STREAM_TIMEOUT, LLM_RETRIES,
+    LLM_HEDGE, LLM_HEDGE_DELAY, LLM_FALLBACK_MODEL, LLM_FALLBACK_URL, LLM_FALLBACK_API_KEY
+)
+from metrics import llm_first_token_seconds, llm_request_seconds, llm_requests, llm_errors, llm_tokens, llm_waiting
+from resilience import LLMError, Provider, retry_delay
 
-async def ask_deepseek(question: str, user_name: str, period: str, message_history=None) -> str:
-    """Отправка вопроса в DeepSeek API с учетом истории сообщений"""
-    if any(re.search(rf'\b{word}', question.lower()) for word in TRIGGER_WORDS):
+logger = logging.getLogger(__name__)
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+
+ERROR_ANSWER = "Извини, у меня временные технические трудности. Попробуй спросить позже."
+
+# Маркер конца потокового ответа в очереди попытки
+_DONE = object()
+
+
+def _chunk_content(provider: Provider, chunk):
+    """Текст фрагмента SSE (учитывает расход токенов из последнего фрагмента). Неожиданная структура — ValueError"""
+    if not isinstance(chunk, dict):
+        raise ValueError(f"Malformed chunk from {provider.name}")
+    usage = chunk.get('usage')
+    if isinstance(usage, dict):
+        llm_tokens.inc(usage.get('prompt_tokens') or 0, provider=provider.name, kind='prompt')
+        llm_tokens.inc(usage.get('completion_tokens') or 0, provider=provider.name, kind='completion')
+    choices = chunk.get('choices')
+    if not choices:
         return None
-    
-    url = "https://api.deepseek.com/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-    }
+    if not isinstance(choices, list) or not isinstance(choices[0], dict):
+        raise ValueError(f"Malformed chunk from {provider.name}")
+    delta = choices[0].get('delta') or {}
+    content = delta.get('content') if isinstance(delta, dict) else None
+    return content if isinstance(content, str) else None
+
+
+class _Attempt:
+    """Один HTTP-запрос к провайдеру: фоновая задача складывает фрагменты ответа в очередь"""
+
+    def __init__(self, provider, task, queue):
+        self.provider = provider
+        self.task = task
+        self.queue = queue
+
+
+class DeepSeekClient:
+    """Клиент DeepSeek API с долгоживущей сессией: соединения и TLS переиспользуются между вопросами.
+    Запросы идут с ограничением времени, повторами, размыкателем и запасными провайдерами"""
+
+    def __init__(self, api_key=DEEPSEEK_API_KEY, url=DEEPSEEK_URL, model=DEEPSEEK_MODEL, cache: AnswerCache = None,
+                 max_concurrency=LLM_MAX_CONCURRENCY, max_waiting=LLM_MAX_WAITING, fallbacks=None):
+        # Основной провайдер и запасные (по порядку); по умолчанию запасной берется из LLM_FALLBACK_*
+        if fallbacks is None:
+            fallbacks = [Provider('fallback', LLM_FALLBACK_URL, LLM_FALLBACK_API_KEY, LLM_FALLBACK_MODEL)] if LLM_FALLBACK_MODEL else []
+        self.providers = [Provider('deepseek', url, api_key, model)] + list(fallbacks)
+        self.cache = cache
+        self.session = None
+        # Общий лимит запросов к API: остальные ждут своей очереди
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        llm_waiting.track(lambda: self.waiting)
+
+    @property
+    def busy(self):
+        """Все слоты заняты: новый запрос будет ждать"""
+        return self._slots.locked()
+
+    @property
+    def overloaded(self):
+        """Очередь к API переполнена: новые вопросы лучше не принимать"""
+        return self.waiting >= self.max_waiting
+
+    @asynccontextmanager
+    async def _slot(self):
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=LLM_POOL_SIZE,
+            limit_per_host=LLM_POOL_SIZE,
+            ttl_dns_cache=LLM_DNS_CACHE_TTL,
+            keepalive_timeout=LLM_KEEPALIVE_TIMEOUT,
+            enable_cleanup_closed=True
+        )
+        timeout = aiohttp.ClientTimeout(total=None, connect=LLM_CONNECT_TIMEOUT, sock_read=LLM_READ_TIMEOUT)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={"Content-Type": "application/json"}
+        )
+        return self
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def _read(self, provider: Provider, body, queue: asyncio.Queue):
+        """Прочитать SSE-ответ провайдера в очередь: фрагменты текста, затем _DONE или исключение"""
+        try:
+            # include_usage: последний фрагмент потока содержит расход токенов
+            data = {**body, "model": provider.model, "stream": True, "stream_options": {"include_usage": True}}
+            async with self.session.post(provider.url, json=data, headers=provider.headers) as response:
+                if response.status >= 400:
+                    retry_after = response.headers.get('Retry-After')
+                    raise LLMError(response.status, float(retry_after) if retry_after and retry_after.isdigit() else None)
+                async for line in response.content:
+                    line = line.decode('utf-8').strip()
+                    if not line.startswith('data:'):
+                        continue
+                    payload = line[len('data:'):].strip()
+                    if payload == '[DONE]':
+                        queue.put_nowait(_DONE)
+                        return
+                    content = _chunk_content(provider, json.loads(payload))
+                    if content:
+                        queue.put_nowait(content)
+            raise aiohttp.ClientPayloadError("Response ended without [DONE]")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            queue.put_nowait(e)
+
+    def _launch(self, provider: Provider, body):
+        queue = asyncio.Queue()
+        return _Attempt(provider, asyncio.create_task(self._read(provider, body, queue)), queue)
 
+    def _hedge_delay(self, provider: Provider):
+        """Когда запускать дублирующий запрос: p95 времени до первого фрагмента у этого провайдера"""
+        p95 = llm_first_token_seconds.quantile(0.95, provider=provider.name)
+        return p95 if p95 is not None and p95 != float('inf') else LLM_HEDGE_DELAY
+
+    async def _race(self, provider: Provider, body):
+        """Дождаться первого фрагмента ответа за LLM_ATTEMPT_TIMEOUT; при LLM_HEDGE после p95 запускается второй запрос
+        и побеждает тот, что ответил раньше. Возвращает (попытка, первый элемент очереди)"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + LLM_ATTEMPT_TIMEOUT
+        hedge_at = started + self._hedge_delay(provider) if LLM_HEDGE else None
+        attempts = [self._launch(provider, body)]
+        getters = {}
+        winner = None
+        try:
+            while True:
+                for attempt in attempts:
+                    if attempt not in getters.values():
+                        getters[asyncio.create_task(attempt.queue.get())] = attempt
+                wake = min(deadline, hedge_at) if hedge_at else deadline
+                done, _ = await asyncio.wait(getters, timeout=max(0.0, wake - loop.time()), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if hedge_at and loop.time() < deadline:
+                        attempts.append(self._launch(provider, body))
+                        hedge_at = None
+                        continue
+                    raise asyncio.TimeoutError()
+
+                error = None
+                for getter in done:
+                    attempt = getters.pop(getter)
+                    item = getter.result()
+                    if isinstance(item, Exception):
+                        attempts.remove(attempt)
+                        error = item
+                    elif winner is None:
+                        winner = (attempt, item)
+                if winner:
+                    llm_first_token_seconds.observe(loop.time() - started, provider=provider.name)
+                    return winner
+                if not attempts:
+                    raise error
+        finally:
+            for getter in getters:
+                getter.cancel()
+            for attempt in attempts:
+                if winner is None or attempt is not winner[0]:
+                    attempt.task.cancel()
+
+    async def _first_response(self, body):
+        """Найти провайдера, который начал отвечать: повторы с джиттером на 429/5xx и таймаутах, затем запасные провайдеры"""
+        for provider in self.providers:
+            breaker = provider.breaker
+            probe = breaker.state == 'half-open'
+            if not breaker.allow():
+                continue
+            try:
+                for retry in range(LLM_RETRIES + 1):
+                    retry_after = None
+                    try:
+                        result = await self._race(provider, body)
+                        breaker.record_success()
+                        return result
+                    except LLMError as e:
+                        logger.warning("Error calling %s: %s", provider.name, e)
+                        llm_errors.inc(provider=provider.name, reason=str(e.status))
+                        if not e.retryable:
+                            # 4xx — ошибка запроса или настройки, а не недоступность провайдера: размыкатель не трогаем
+                            break
+                        breaker.record_failure()
+                        retry_after = e.retry_after
+                    except Exception as e:
+                        # Таймаут, сеть или испорченный поток — провайдер считается сбойным
+                        logger.warning("Error calling %s: %r", provider.name, e)
+                        llm_errors.inc(provider=provider.name, reason='timeout' if isinstance(e, asyncio.TimeoutError) else type(e).__name__)
+                        breaker.record_failure()
+                    # Провайдер признан недоступным — сразу к запасному
+                    if retry == LLM_RETRIES or breaker.state == 'open':
+                        break
+                    await asyncio.sleep(retry_delay(retry + 1, retry_after))
+            finally:
+                # Пробный запрос без результата (отмена, 4xx) возвращается, иначе размыкатель не пропустит следующий
+                if probe:
+                    breaker.release_probe()
+        return None
+
+    async def _generate(self, body):
+        """Фрагменты ответа; в конце None, если ответ пришел полностью.
+        Ошибки до первого фрагмента скрыты повторами и запасными провайдерами; после него частичный ответ остается"""
+        async with self._slot():
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            first = await self._first_response(body)
+            if first is None:
+                llm_requests.inc(provider='none', outcome='error')
+                return
+            attempt, item = first
+            deadline = loop.time() + LLM_STREAM_TIMEOUT
+            complete = False
+            try:
+                while item is not _DONE:
+                    if isinstance(item, Exception):
+                        return
+                    yield item
+                    item = await asyncio.wait_for(attempt.queue.get(), max(0.0, deadline - loop.time()))
+                complete = True
+                yield None
+            except asyncio.TimeoutError:
+                return
+            finally:
+                attempt.task.cancel()
+                name = attempt.provider.name
+                llm_requests.inc(provider=name, outcome='ok' if complete else 'incomplete')
+                if complete:
+                    llm_request_seconds.observe(loop.time() - started, provider=name)
+
+    async def _complete(self, body):
+        """Полный текст ответа или None, если ответ не получен целиком"""
+        chunks = []
+        async for chunk in self._generate(body):
+            if chunk is None:
+                return ''.join(chunks)
+            chunks.append(chunk)
+        return None
+
+    async def stream(self, question: str, user_name: str, period: str, message_history=None, summary=None):
+        """Потоковый ответ DeepSeek (SSE): отдает фрагменты текста по мере генерации"""
+        # Кэш используется только для вопросов без истории: с контекстом ответ зависит от диалога
+        use_cache = self.cache is not None and not message_history and not summary
+        if use_cache:
+            cached = self.cache.get(question, period, user_name)
+            if cached is not None:
+                yield cached
+                return
+        
+        body = {
+            "messages": build_messages(question, user_name, period, message_history, summary),
+            "temperature": 0.7,
+            "max_tokens": 500
+        }
+        
+        chunks = []
+        complete = False
+        async for chunk in self._generate(body):
+            if chunk is None:
+                complete = True
+            else:
+                chunks.append(chunk)
+                yield chunk
+        
+        # Если ответа нет совсем (ошибка API, пустой ответ), отдаем извинение; частичный ответ оставляем как есть
+        if not chunks:
+            yield ERROR_ANSWER
+        elif complete and use_cache:
+            self.cache.put(question, period, ''.join(chunks), user_name)
+
+
+    async def summarize(self, summary, turns):
+        """Свернуть реплики диалога в краткое содержание с учетом предыдущего; None при ошибке"""
+        dialog = "\n".join(
+            f"{'Пользователь' if turn['role'] == 'user' else 'Помощник'}: {turn['content']}"
+            for turn in turns
+        )
+        prompt = (
+            "Обнови краткое содержание разговора пользователя с помощником. "
+            "Сохрани важные факты о пользователе и ребенке, темы и договоренности. Не больше 5 предложений.\n\n"
+            f"Прежнее содержание: {summary or 'нет'}\n\nНовые реплики:\n{dialog}"
+        )
+        return await self._complete({
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": 0.3,
+            "max_tokens": SUMMARY_MAX_TOKENS
+        })
+
+
+def build_messages(question: str, user_name: str, period: str, message_history=None, summary=None):
+    """Сформировать список сообщений для API: системный промпт, история и текущий вопрос"""
     system_prompt = f"""Ты — тёплый, спокойный помощник для женщин на этапах беременности и материнства. Отвечай кратко, без диагнозов, без осуждения. Помни имя ({user_name}) и этап ({period}). Никогда не повторяй первоначальное приветствие. Продолжай разговор с учётом контекста. Предлагай "материалы" и "задать вопрос", когда это уместно."""
 
     # Формируем список сообщений для API
     messages = [{"role": "system", "content": system_prompt}]
     
+    # Краткое содержание более ранней части разговора
+    if summary:
+        messages.append({"role": "system", "content": f"Краткое содержание предыдущего разговора: {summary}"})
+    
     # Добавляем историю сообщений (если есть)
     if message_history:
         for msg in message_history:
@@ -33,19 +344,19 @@ async def ask_deepseek(question: str, user_name: str, period: str, message_histo
         "role": "user",
         "content": question
     })
-    
-    data = {
-        "model": "deepseek-chat",
-        "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 500
-    }
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=data) as response:
-                result = await response.json()
-                return result['choices'][0]['message']['content']
-    except Exception as e:
-        #print(f"Error calling DeepSeek API: {e}")
-        return "Извини, у меня временные технические трудности. Попробуй спросить позже."
\ No newline at end of file
+    return messages
+
+
+def spawn(coro):
+    """Запустить корутину в фоне, не блокируя обработчик"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(_log_failure)
+    return task
+
+
+def _log_failure(task):
+    # Иначе исключение фоновой задачи никто не увидит
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Фоновая задача завершилась с ошибкой", exc_info=task.exception())
@@ -0,0 +1,75 @@
+import asyncio
+import secrets
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_CONCURRENCY, WEBHOOK_MAX_CONNECTIONS
+)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookHandler(SimpleRequestHandler):
+    """Прием обновлений от Telegram: проверка секрета, ответ сразу, обработка в фоне.
+    Одновременно обрабатывается не больше concurrency обновлений; при перегрузке ответ задерживается,
+    и Telegram сам снижает темп отправки"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token, concurrency=WEBHOOK_CONCURRENCY, **data):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.secret_token = secret_token
+        self._slots = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not secrets.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret_token):
+            raise web.HTTPUnauthorized()
+        update = await request.json(loads=self.bot.session.json_loads)
+        await self._slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return web.json_response({}, dumps=self.bot.session.json_dumps)
+
+    __call__ = handle
+
+    async def _process(self, update):
+        try:
+            await self._background_feed_update(bot=self.bot, update=update)
+        finally:
+            self._slots.release()
+
+    async def close(self) -> None:
+        # Даем доработать уже принятым обновлениям: Telegram не пришлет их повторно
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+        await super().close()
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, **data):
+    """Запустить HTTP-сервер для вебхука и зарегистрировать его в Telegram. Работает до отмены"""
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_URL and WEBHOOK_SECRET must be set for webhook mode")
+
+    app = web.Application()
+    WebhookHandler(dp, bot, secret_token=WEBHOOK_SECRET, **data).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+
+    # Повторная установка того же адреса безопасна: каждая реплика может вызывать её при старте
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    await dp.emit_startup(bot=bot, **data)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await dp.emit_shutdown(bot=bot, **data)
+        # Webhook в Telegram не снимаем: обновления будут ждать следующего запуска или другую реплику
+        await runner.cleanup()
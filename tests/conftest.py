@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули бота лежат плоско в src и импортируются по имени, как при запуске src/main.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
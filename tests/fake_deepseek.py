@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+from aiohttp import web
+
+
+class FakeDeepSeek:
+    """Локальный OpenAI-совместимый сервер с потоковыми ответами (SSE) для проверки клиента LLM.
+    Поведение задается сценарием на каждый путь: список режимов, по одному на запрос; когда он кончится — 'ok'.
+    Режимы: 'ok', HTTP-статус (429, 500, 400...), 'hang' (не отвечает), 'slow' (отвечает через delay секунд),
+    'cut' (обрыв без [DONE]), 'null_delta' (фрагмент с "delta": null), 'garbage' (не JSON)"""
+
+    def __init__(self, words=('При', 'вет')):
+        self.words = words
+        self.scripts = {}
+        self.calls = []
+        self.delay = 0.3
+        self._runner = None
+        self.port = None
+
+    def script(self, path, *modes):
+        self.scripts[path] = list(modes)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.port}/{path}"
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/{path}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        # Зависшие запросы ('hang') не задерживают остановку сервера
+        site = web.TCPSite(self._runner, '127.0.0.1', 0, shutdown_timeout=0.1)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        await self._runner.cleanup()
+
+    async def _handle(self, request):
+        path = request.match_info['path']
+        body = await request.json()
+        self.calls.append((path, body['model'], request.headers.get('Authorization')))
+        script = self.scripts.get(path)
+        mode = script.pop(0) if script else 'ok'
+
+        if isinstance(mode, int):
+            return web.Response(status=mode, headers={'Retry-After': '0'} if mode == 429 else None)
+        if mode == 'hang':
+            await asyncio.sleep(3600)
+        if mode == 'slow':
+            await asyncio.sleep(self.delay)
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        if mode == 'null_delta':
+            await self._send(response, {'choices': [{'delta': None}]})
+        if mode == 'garbage':
+            await response.write(b"data: {not json\n\n")
+        for word in self.words:
+            await self._send(response, {'choices': [{'delta': {'content': word}}]})
+        await self._send(response, {'choices': [], 'usage': {'prompt_tokens': 10, 'completion_tokens': 2}})
+        if mode != 'cut':
+            await response.write(b"data: [DONE]\n\n")
+        return response
+
+    @staticmethod
+    async def _send(response, chunk):
+        await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
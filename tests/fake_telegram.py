@@ -0,0 +1,85 @@
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import ClientSession, web
+
+TOKEN = '42:TEST'
+
+
+class FakeTelegram:
+    """Локальный Bot API: запоминает вызванные методы с параметрами и отвечает успехом.
+    sendMessage возвращает сообщение с текстом запроса, остальные методы — True"""
+
+    def __init__(self):
+        self.calls = []
+        self._runner = None
+        self.port = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0, shutdown_timeout=0.1)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        await self._runner.cleanup()
+
+    def bot(self):
+        """Бот, который ходит в этот сервер вместо api.telegram.org"""
+        api = TelegramAPIServer.from_base(f"http://127.0.0.1:{self.port}")
+        return Bot(token=TOKEN, session=AiohttpSession(api=api))
+
+    def sent(self, method='sendMessage'):
+        return [params for name, params in self.calls if name == method]
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        params = dict(await request.post())
+        self.calls.append((method, params))
+        result = True
+        if method == 'sendMessage':
+            result = {
+                'message_id': len(self.calls),
+                'date': int(time.time()),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'},
+                'text': params['text'],
+            }
+        return web.json_response({'ok': True, 'result': result})
+
+
+def message_update(update_id, text, user_id=5):
+    """Обновление с текстовым сообщением в личном чате, как его присылает Telegram"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Аня'}
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': user,
+            'text': text,
+        },
+    }
+
+
+class WebhookClient:
+    """Отправляет обновления на вебхук так же, как Telegram: POST JSON с секретом в заголовке"""
+
+    def __init__(self, url, secret):
+        self.url = url
+        self.secret = secret
+        self._session = ClientSession()
+
+    async def post(self, update, secret=None):
+        headers = {'X-Telegram-Bot-Api-Secret-Token': self.secret if secret is None else secret}
+        async with self._session.post(self.url, json=update, headers=headers) as response:
+            return response.status
+
+    async def close(self):
+        await self._session.close()
@@ -0,0 +1,21 @@
+from answer_cache import AnswerCache
+
+
+def test_name_is_templated_only_as_whole_word_in_greeting():
+    cache = AnswerCache(similarity=0)
+    cache.put('Можно кофе?', 'Беременность', 'Мария, можно. Дайте знать, если что-то беспокоит.', 'Мария')
+    assert cache.get('можно кофе', 'Беременность', 'Анна') == 'Анна, можно. Дайте знать, если что-то беспокоит.'
+
+
+def test_short_name_is_not_cached():
+    cache = AnswerCache(similarity=0)
+    cache.put('Можно кофе?', 'Беременность', 'Да, можно. Дайте знать, если что-то беспокоит.', 'Да')
+    assert cache.get('Можно кофе?', 'Беременность', 'Мария') is None
+
+
+def test_name_outside_greeting_is_not_cached():
+    cache = AnswerCache(similarity=0)
+    cache.put('Что делать?', 'Беременность', 'Отдохни. Вера, всё будет хорошо.', 'Вера')
+    assert cache.get('Что делать?', 'Беременность', 'Анна') is None
+    cache.put('Как спать?', 'Беременность', 'Привет, вера! Спи на боку.', 'Вера')
+    assert cache.get('Как спать?', 'Беременность', 'Анна') == 'Привет, Анна! Спи на боку.'
@@ -0,0 +1,173 @@
+import asyncio
+
+import pytest
+
+import utils
+from fake_deepseek import FakeDeepSeek
+from resilience import CircuitBreaker, Provider
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(utils, 'retry_delay', lambda attempt, retry_after=None: 0)
+    monkeypatch.setattr(utils, 'LLM_ATTEMPT_TIMEOUT', 0.5)
+    monkeypatch.setattr(utils, 'LLM_RETRIES', 2)
+    monkeypatch.setattr(utils, 'LLM_HEDGE', False)
+
+
+def run(scenario, fallback=True, breaker_failures=3, breaker_reset=30):
+    """Запустить сценарий с клиентом, настроенным на фейковый сервер: основной путь main, запасной backup"""
+    async def main():
+        server = await FakeDeepSeek().start()
+        fallbacks = [Provider('backup', server.url('backup'), 'key2', 'model2')] if fallback else []
+        client = utils.DeepSeekClient(api_key='key1', url=server.url('main'), model='model1', fallbacks=fallbacks)
+        for provider in client.providers:
+            provider.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        await client.start()
+        try:
+            return await scenario(server, client)
+        finally:
+            await client.close()
+            await server.close()
+    return asyncio.run(main())
+
+
+async def answer(client):
+    return ''.join([chunk async for chunk in client.stream('вопрос', 'Аня', 'беременна')])
+
+
+def test_answer_streams_from_main_provider():
+    async def scenario(server, client):
+        assert await answer(client) == 'Привет'
+        assert server.calls == [('main', 'model1', 'Bearer key1')]
+    run(scenario)
+
+
+def test_retryable_statuses_are_retried():
+    async def scenario(server, client):
+        server.script('main', 429, 500)
+        assert await answer(client) == 'Привет'
+        assert [path for path, _, _ in server.calls] == ['main', 'main', 'main']
+        assert client.providers[0].breaker.state == 'closed'
+    run(scenario)
+
+
+def test_client_error_goes_to_fallback_without_opening_breaker():
+    async def scenario(server, client):
+        server.script('main', 400)
+        assert await answer(client) == 'Привет'
+        assert server.calls[-1][:2] == ('backup', 'model2')
+        assert client.providers[0].breaker._failed == 0
+    run(scenario)
+
+
+def test_timeouts_and_exhausted_retries_fall_back():
+    async def scenario(server, client):
+        server.script('main', 'hang', 500, 503)
+        assert await answer(client) == 'Привет'
+        assert [path for path, _, _ in server.calls] == ['main', 'main', 'main', 'backup']
+    run(scenario)
+
+
+def test_breaker_opens_and_skips_provider():
+    async def scenario(server, client):
+        server.script('main', 500, 500, 500)
+        await answer(client)
+        assert client.providers[0].breaker.state == 'open'
+        server.calls.clear()
+        assert await answer(client) == 'Привет'
+        assert [path for path, _, _ in server.calls] == ['backup']
+    run(scenario)
+
+
+def test_breaker_half_open_probe_closes_on_success():
+    async def scenario(server, client):
+        server.script('main', 500, 500, 500)
+        await answer(client)
+        breaker = client.providers[0].breaker
+        breaker._opened_at -= breaker.reset
+        assert breaker.state == 'half-open'
+        server.calls.clear()
+        assert await answer(client) == 'Привет'
+        assert [path for path, _, _ in server.calls] == ['main']
+        assert breaker.state == 'closed'
+    run(scenario)
+
+
+def test_breaker_half_open_probe_failure_reopens():
+    async def scenario(server, client):
+        server.script('main', 500, 500, 500, 500)
+        await answer(client)
+        breaker = client.providers[0].breaker
+        breaker._opened_at -= breaker.reset
+        server.calls.clear()
+        assert await answer(client) == 'Привет'
+        assert [path for path, _, _ in server.calls] == ['main', 'backup']
+        assert breaker.state == 'open'
+    run(scenario)
+
+
+def test_cancelled_probe_is_released():
+    async def scenario(server, client):
+        server.script('main', 500, 500, 500, 'hang')
+        await answer(client)
+        breaker = client.providers[0].breaker
+        breaker._opened_at -= breaker.reset
+        task = asyncio.create_task(answer(client))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Пробный запрос отменен — следующий вопрос снова может проверить провайдера
+        assert breaker.allow()
+    run(scenario)
+
+
+def test_null_delta_is_skipped():
+    async def scenario(server, client):
+        server.script('main', 'null_delta')
+        assert await answer(client) == 'Привет'
+        assert [path for path, _, _ in server.calls] == ['main']
+    run(scenario)
+
+
+def test_malformed_stream_is_provider_error():
+    async def scenario(server, client):
+        server.script('main', 'garbage', 'garbage', 'garbage')
+        assert await answer(client) == 'Привет'
+        assert [path for path, _, _ in server.calls] == ['main', 'main', 'main', 'backup']
+    run(scenario)
+
+
+def test_all_providers_down_gives_apology():
+    async def scenario(server, client):
+        server.script('main', 500, 500, 500)
+        server.script('backup', 500, 500, 500)
+        assert await answer(client) == utils.ERROR_ANSWER
+        assert await client.summarize(None, [{'role': 'user', 'content': 'привет'}]) is None
+    run(scenario)
+
+
+def test_broken_stream_keeps_partial_answer():
+    async def scenario(server, client):
+        server.script('main', 'cut')
+        assert await answer(client) == 'Привет'
+        # Неполный ответ не кэшируется и не считается полным для summarize
+        server.script('main', 'cut')
+        assert await client.summarize(None, [{'role': 'user', 'content': 'привет'}]) is None
+    run(scenario, fallback=False)
+
+
+def test_hedged_request_wins_over_slow_one(monkeypatch):
+    monkeypatch.setattr(utils, 'LLM_HEDGE', True)
+    monkeypatch.setattr(utils, 'LLM_HEDGE_DELAY', 0.05)
+    monkeypatch.setattr(utils.DeepSeekClient, '_hedge_delay', lambda self, provider: 0.05)
+
+    async def scenario(server, client):
+        server.script('main', 'hang')
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert await answer(client) == 'Привет'
+        assert loop.time() - started < 0.4
+        assert [path for path, _, _ in server.calls] == ['main', 'main']
+    run(scenario)
@@ -0,0 +1,147 @@
+import asyncio
+import socket
+
+from aiogram import Dispatcher, Router
+from aiohttp import web
+
+import webhook
+from fake_telegram import FakeTelegram, WebhookClient, message_update
+from user_cache import user_cache
+from webhook import WebhookHandler
+
+SECRET = 'secret'
+
+
+async def wait_for(condition, timeout=2):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "условие не выполнилось"
+        await asyncio.sleep(0.01)
+
+
+def run(dispatcher, scenario, concurrency=100, **data):
+    """Поднять фейковый Bot API и вебхук на локальном порту и выполнить сценарий"""
+    async def main():
+        telegram = await FakeTelegram().start()
+        bot = telegram.bot()
+        app = web.Application()
+        WebhookHandler(dispatcher, bot, secret_token=SECRET, concurrency=concurrency, **data).register(app, path='/webhook')
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0, shutdown_timeout=0.1)
+        await site.start()
+        client = WebhookClient(f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/webhook", SECRET)
+        try:
+            return await scenario(telegram, client)
+        finally:
+            await client.close()
+            await runner.cleanup()
+            await telegram.close()
+    return asyncio.run(main())
+
+
+def echo_dispatcher(seen):
+    router = Router()
+
+    @router.message()
+    async def echo(message):
+        seen.append(message.text)
+
+    dispatcher = Dispatcher()
+    dispatcher.include_router(router)
+    return dispatcher
+
+
+def test_wrong_or_missing_secret_is_rejected():
+    seen = []
+
+    async def scenario(telegram, client):
+        assert await client.post(message_update(1, 'чужой'), secret='wrong') == 401
+        assert await client.post(message_update(2, 'без секрета'), secret='') == 401
+        assert await client.post(message_update(3, 'свой')) == 200
+        await wait_for(lambda: seen)
+        assert seen == ['свой']
+    run(echo_dispatcher(seen), scenario)
+
+
+def test_concurrency_is_capped():
+    release = asyncio.Event()
+    active = []
+    peak = []
+    router = Router()
+
+    @router.message()
+    async def slow(message):
+        active.append(message.text)
+        peak.append(len(active))
+        await release.wait()
+        active.remove(message.text)
+
+    dispatcher = Dispatcher()
+    dispatcher.include_router(router)
+
+    async def scenario(telegram, client):
+        release.clear()
+        posts = [asyncio.create_task(client.post(message_update(i, str(i)))) for i in range(3)]
+        await wait_for(lambda: len(active) == 2)
+        await asyncio.sleep(0.1)
+        # Третье обновление ждет свободного места: ответ Telegram задерживается, обработка не начинается
+        assert len(active) == 2
+        assert sum(post.done() for post in posts) == 2
+        release.set()
+        assert await asyncio.gather(*posts) == [200, 200, 200]
+        await wait_for(lambda: not active)
+        assert max(peak) == 2
+    run(dispatcher, scenario, concurrency=2)
+
+
+def test_updates_reach_bot_router():
+    from handlers import router
+
+    dispatcher = Dispatcher()
+    dispatcher.include_router(router)
+    # Профиль в кэше: зарегистрированный пользователь обслуживается без обращений к БД
+    user_cache.set(5, {'name': 'Аня', 'period': 'Беременность', 'daily_support_enabled': False,
+                       'timezone': None, 'delivery_time': None, 'question_count': 0})
+
+    async def scenario(telegram, client):
+        assert await client.post(message_update(1, '/start')) == 200
+        await wait_for(lambda: telegram.sent())
+        [reply] = telegram.sent()
+        assert reply['chat_id'] == '5'
+        assert reply['text'] == 'Выбери, что тебя интересует:'
+        assert 'keyboard' in reply['reply_markup']
+    try:
+        run(dispatcher, scenario, pool=None)
+    finally:
+        user_cache.invalidate(5)
+
+
+def test_run_webhook_registers_webhook_and_serves_updates(monkeypatch):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setattr(webhook, 'WEBHOOK_URL', 'https://bot.example.com/')
+    monkeypatch.setattr(webhook, 'WEBHOOK_SECRET', SECRET)
+    monkeypatch.setattr(webhook, 'WEBHOOK_HOST', '127.0.0.1')
+    monkeypatch.setattr(webhook, 'WEBHOOK_PORT', port)
+    seen = []
+
+    async def main():
+        telegram = await FakeTelegram().start()
+        server = asyncio.create_task(webhook.run_webhook(echo_dispatcher(seen), telegram.bot()))
+        client = WebhookClient(f"http://127.0.0.1:{port}{webhook.WEBHOOK_PATH}", SECRET)
+        try:
+            await wait_for(lambda: telegram.sent('setWebhook'))
+            [registered] = telegram.sent('setWebhook')
+            assert registered['url'] == 'https://bot.example.com' + webhook.WEBHOOK_PATH
+            assert registered['secret_token'] == SECRET
+            assert await client.post(message_update(1, 'привет')) == 200
+            await wait_for(lambda: seen)
+        finally:
+            await client.close()
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+            await telegram.close()
+    asyncio.run(main())
+    assert seen == ['привет']